@@ -1,12 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-import pandas as pd
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 import os
+import io
+import csv
 import json
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
-from functools import lru_cache
-from classify import classify_csv
+from classify import warm_up
 import sqlite3
+import columnar
+import db
+import jobs
+import metrics
+import reclassify
+import rollups
 
 # Load environment variables
 load_dotenv()
@@ -25,49 +31,57 @@ if not os.path.exists('dataset'):
 
 # Initialize database
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL
-        )
-    ''')
-    # Create uploads table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS uploads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            file_name TEXT NOT NULL,
-            upload_date TEXT NOT NULL,
-            table_name TEXT NOT NULL,
-            FOREIGN KEY (username) REFERENCES users (username)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    conn = db.connect(DB_PATH)
+    with conn:
+        # Create users table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL
+            )
+        ''')
+        # Create uploads table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                upload_date TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                FOREIGN KEY (username) REFERENCES users (username)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_table_name ON uploads (table_name COLLATE NOCASE)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_username ON uploads (username, upload_date)')
+        # Label counts per result table, written once when an upload is stored
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_label_counts (
+                table_name TEXT NOT NULL,
+                target_label TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                first_id INTEGER NOT NULL,
+                PRIMARY KEY (table_name, target_label)
+            )
+        ''')
 
 init_db()
+jobs.init_jobs_table(DB_PATH)
+jobs.resume_queued_jobs(DB_PATH)  # Pick up jobs queued before a restart
+rollups.init_rollup_table(DB_PATH)
+reclassify.init_reclassify_table(DB_PATH)
+reclassify.resume_runs(DB_PATH)
+if os.getenv('RECLASSIFY_ON_START') == '1':
+    # Roll a new model or rule set out to every stored upload, in the background
+    reclassify.enqueue_stale(DB_PATH)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_unique_table_name(base_name):
-    """Generate a unique table name by appending a numeric postfix if needed."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    postfix = 0
-    unique_name = base_name
-    while True:
-        cursor.execute('SELECT 1 FROM uploads WHERE table_name = ?', (unique_name,))
-        if cursor.fetchone() is None:
-            break
-        postfix += 1
-        unique_name = f"{base_name}_{postfix}"
-    conn.close()
-    return unique_name
+# Models load lazily on first use; WARM_UP_MODELS=1 loads them at import instead,
+# so a pre-fork server (e.g. gunicorn --preload) shares them across workers
+if os.getenv('WARM_UP_MODELS') == '1':
+    warm_up()
 
 # Create Flask application instance
 app = Flask(__name__)
@@ -79,24 +93,44 @@ app.config.update(
     TEMPLATES_AUTO_RELOAD=True,
     SEND_FILE_MAX_AGE_DEFAULT=0,
     UPLOAD_FOLDER=UPLOAD_FOLDER,
-    MAX_CONTENT_LENGTH=16 * 1024 * 1024  # 16MB max file size
+    JOB_OUTPUT_DIR=os.getenv('JOB_OUTPUT_DIR'),  # set to also keep a labelled CSV per job
+    # 16MB max file size by default; classify_csv streams, so larger limits are safe
+    MAX_CONTENT_LENGTH=int(os.getenv('MAX_UPLOAD_MB', 16)) * 1024 * 1024
 )
 
-# Cache for expensive operations
-@lru_cache(maxsize=32)
-def get_classification_results():
-    try:
-        df = pd.read_csv('dataset/output.csv')
-        return {
-            'label_counts': df['target_label'].value_counts().to_dict(),
-            'total_logs': len(df),
-            'unique_labels': df['target_label'].unique().tolist()
-        }
-    except Exception:
-        return None
+# Number of rows per page on the filter page, and per fetch when exporting a label
+FILTER_PAGE_SIZE = int(os.getenv('FILTER_PAGE_SIZE', 100))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+def get_classification_results(table_name):
+    """Label summary of a result table, read from upload_label_counts."""
+    label_counts = jobs.get_label_counts(db.connect(DB_PATH), table_name)
+    return {
+        'label_counts': label_counts,
+        'total_logs': sum(label_counts.values()),
+        'unique_labels': list(label_counts)
+    }
+
+def get_results_table():
+    """Result table shown by the results and filter pages for the current session."""
+    if 'user' not in session:
+        # Non-logged-in users: the table of their last finished job
+        return session.get('results_table')
 
-# Temporary storage for non-logged-in users
-temporary_results = None
+    # Use the table_name from session if present
+    table_name = session.get('current_table_name')
+    if table_name:
+        return table_name
+
+    # fallback to the most recent upload
+    result = db.connect(DB_PATH).execute('''
+        SELECT table_name
+        FROM uploads
+        WHERE username = ?
+        ORDER BY upload_date DESC
+        LIMIT 1
+    ''', (session['user'],)).fetchone()
+    return result[0] if result else None
 
 @app.route('/')
 def index():
@@ -109,11 +143,9 @@ def register():
         password = request.form['password']
         hashed_password = generate_password_hash(password)
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password))
-            conn.commit()
-            conn.close()
+            conn = db.connect(DB_PATH)
+            with conn:
+                conn.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, hashed_password))
             flash('Registration successful. Please log in.')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
@@ -126,11 +158,7 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT password FROM users WHERE username = ?', (username,))
-        user = cursor.fetchone()
-        conn.close()
+        user = db.connect(DB_PATH).execute('SELECT password FROM users WHERE username = ?', (username,)).fetchone()
         if user and check_password_hash(user[0], password):
             session['user'] = username
             flash('Login successful.')
@@ -155,7 +183,6 @@ def account():
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_file():
-    global temporary_results  # Ensure we use the global variable
     try:
         if request.method == 'POST':
             if 'file' not in request.files:
@@ -168,49 +195,16 @@ def upload_file():
                 return redirect(url_for('upload_file'))
             
             if file and allowed_file(file.filename):
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                file.save(filepath)
-
-                # Classify the file
-                try:
-                    output_file = classify_csv(filepath)
-                    df = pd.read_csv(output_file)
-
-                    # If logged in, save to the database
-                    if 'user' in session:
-                        conn = sqlite3.connect(DB_PATH)
-                        cursor = conn.cursor()
-                        file_name = file.filename.rsplit('.', 1)[0]
-                        upload_date = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
-                        table_name = generate_unique_table_name(file_name)
-                        cursor.execute(f'''
-                            CREATE TABLE IF NOT EXISTS {table_name} (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                source TEXT,
-                                log_message TEXT,
-                                target_label TEXT
-                            )
-                        ''')
-                        df.to_sql(table_name, conn, if_exists='append', index=False)
-                        cursor.execute('''
-                            INSERT INTO uploads (username, file_name, upload_date, table_name)
-                            VALUES (?, ?, ?, ?)
-                        ''', (session['user'], file_name, upload_date, table_name))
-                        conn.commit()
-                        conn.close()
-
-                        # Redirect logged-in users to /user/uploads
-                        flash('File uploaded and classified successfully.')
-                        return redirect(url_for('user_uploads'))
-
-                    # For non-logged-in users, store results temporarily
-                    session['results'] = df.to_json(orient='split')
-                    temporary_results = df.copy()  # fallback for legacy
-                    flash('File uploaded and classified successfully.')
-                    return redirect(url_for('results'))
-                except Exception as e:
-                    flash(f"Error processing file: {str(e)}")
-                    return redirect(url_for('upload_file'))
+                # Queue the file for classification, a worker from the job pool picks it up
+                job = jobs.create_job(DB_PATH, session.get('user'), file.filename,
+                                      upload_dir=app.config['UPLOAD_FOLDER'],
+                                      output_dir=app.config['JOB_OUTPUT_DIR'])
+                file.save(job['input_path'])
+                jobs.submit_job(DB_PATH, job['id'])
+
+                # Non-logged-in users may only follow jobs started from their session
+                session['jobs'] = session.get('jobs', [])[-9:] + [job['id']]
+                return redirect(url_for('job_status', job_id=job['id']))
             else:
                 flash('Invalid file type')
                 return redirect(url_for('upload_file'))
@@ -221,6 +215,56 @@ def upload_file():
         print(f"Error rendering upload template: {str(e)}")
         return str(e), 500
 
+def get_accessible_job(job_id):
+    """Return the job if the current session may see it, otherwise None."""
+    job = jobs.get_job(DB_PATH, job_id)
+    if job is None:
+        return None
+    if job['username']:
+        return job if job['username'] == session.get('user') else None
+    return job if job_id in session.get('jobs', []) else None
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_accessible_job(job_id)
+    if job is None:
+        flash('Job not found.')
+        return redirect(url_for('upload_file'))
+
+    if job['status'] == 'failed':
+        flash(f"Error processing file: {job['error']}")
+        return redirect(url_for('upload_file'))
+
+    if job['status'] == 'done':
+        flash('File uploaded and classified successfully.')
+        if job['username']:
+            # Redirect logged-in users to /user/uploads
+            return redirect(url_for('user_uploads'))
+
+        # Non-logged-in users see the job's temporary table
+        session['results_table'] = job['table_name']
+        return redirect(url_for('results'))
+
+    return render_template('job.html', job=job, user=session.get('user'))
+
+@app.route('/jobs/<job_id>/status')
+def job_status_json(job_id):
+    job = get_accessible_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({
+        'id': job['id'],
+        'status': job['status'],
+        'rows_processed': job['rows_processed'],
+        'error': job['error'],
+        'timings': json.loads(job['timings']) if job['timings'] else None,
+        'unique_rows': job['unique_rows'],
+        # Share of rows answered from an identical row of the same chunk
+        'duplication_ratio': (1 - job['unique_rows'] / job['rows_processed']
+                              if job['unique_rows'] and job['rows_processed'] else None),
+        'redirect': url_for('job_status', job_id=job_id) if job['status'] in ('done', 'failed') else None,
+    })
+
 @app.route('/user/uploads')
 def user_uploads():
     if 'user' not in session:
@@ -230,74 +274,66 @@ def user_uploads():
     # Clear the current_table_name when leaving the results/filter context
     session.pop('current_table_name', None)
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
+    uploads = db.connect(DB_PATH).execute('''
         SELECT file_name, upload_date, table_name
         FROM uploads
         WHERE username = ?
         ORDER BY upload_date DESC
-    ''', (session['user'],))
-    uploads = cursor.fetchall()
-    conn.close()
+    ''', (session['user'],)).fetchall()
     return render_template('user_uploads.html', uploads=uploads, user=session.get('user'))
 
+@app.route('/user/uploads/<table_name>/delete', methods=['POST'])
+def delete_upload(table_name):
+    if 'user' not in session:
+        flash('Please log in to manage your uploads.')
+        return redirect(url_for('login'))
+    if jobs.delete_upload(db.connect(DB_PATH), session['user'], table_name):
+        if session.get('current_table_name') == table_name:
+            session.pop('current_table_name')
+        flash('Upload deleted.')
+    else:
+        flash('You do not have access to this upload.')
+    return redirect(url_for('user_uploads'))
+
+@app.route('/user/dashboard')
+def user_dashboard():
+    """Label counts across all of the user's uploads, by time bucket, source and upload, from the rollups."""
+    if 'user' not in session:
+        return jsonify({'error': 'Please log in'}), 401
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in rollups.BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(rollups.BUCKETS)}"}), 400
+    conn = db.connect(DB_PATH)
+    rollups.backfill(conn, session['user'])  # uploads stored before rollups existed
+    return jsonify(rollups.dashboard(conn, session['user'], bucket))
+
 @app.route('/user/uploads/<table_name>')
 def view_upload_results(table_name):
     if 'user' not in session:
         flash('Please log in to view results.')
         return redirect(url_for('login'))
-    # Store the current table_name in session for filtering
-    session['current_table_name'] = table_name
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT 1 FROM uploads WHERE table_name = ? AND username = ?', (table_name, session['user']))
-    if cursor.fetchone() is None:
-        conn.close()
+    owned = db.connect(DB_PATH).execute(
+        'SELECT 1 FROM uploads WHERE table_name = ? AND username = ?', (table_name, session['user'])).fetchone()
+    if owned is None:
         flash('You do not have access to this upload.')
         return redirect(url_for('user_uploads'))
-    df = pd.read_sql_query(f'SELECT * FROM {table_name}', conn)
-    conn.close()
+    # Store the current table_name in session for filtering
+    session['current_table_name'] = table_name
+    cached_results = get_classification_results(table_name)
     return render_template('results.html', 
-                           label_counts=df['target_label'].value_counts().to_dict(),
-                           total_logs=len(df),
-                           labels=df['target_label'].unique(),
+                           label_counts=cached_results['label_counts'],
+                           total_logs=cached_results['total_logs'],
+                           labels=cached_results['unique_labels'],
                            user=session.get('user'))
 
 @app.route('/results')
 def results():
-    global temporary_results  # Use the global variable for temporary storage
     try:
-        if 'user' in session:
-            # Use the table_name from session if present
-            table_name = session.get('current_table_name')
-            if table_name:
-                conn = sqlite3.connect(DB_PATH)
-                df = pd.read_sql_query(f'SELECT * FROM {table_name}', conn)
-                conn.close()
-                cached_results = {
-                    'label_counts': df['target_label'].value_counts().to_dict(),
-                    'total_logs': len(df),
-                    'unique_labels': df['target_label'].unique()
-                }
-            else:
-                cached_results = get_classification_results()
-        else:
-            # Non-logged-in users: Use the session-stored results
-            df = None
-            if 'results' in session:
-                df = pd.read_json(session['results'], orient='split')
-            elif temporary_results is not None:
-                df = temporary_results
-            if df is None or df.empty:
-                flash('No classification results found')
-                return redirect(url_for('upload_file'))
-            
-            cached_results = {
-                'label_counts': df['target_label'].value_counts().to_dict(),
-                'total_logs': len(df),
-                'unique_labels': df['target_label'].unique()
-            }
+        table_name = get_results_table()
+        if not table_name:
+            flash('No classification results found')
+            return redirect(url_for('user_uploads' if 'user' in session else 'upload_file'))
+        cached_results = get_classification_results(table_name)
 
         return render_template('results.html', 
                                label_counts=cached_results['label_counts'],
@@ -308,63 +344,99 @@ def results():
         print(f"Error rendering results template: {str(e)}")
         return str(e), 500
 
+def get_filter_page(table_name, label, after=None, before=None):
+    """Keyset pagination over the (target_label, id) index.
+
+    Returns (rows, has_previous, has_next); rows come after the id `after`,
+    or before the id `before`, in id order.
+    """
+    table = columnar.open_table(table_name)
+    if table is not None:
+        return table.page(label, FILTER_PAGE_SIZE, after, before)
+    conn = db.connect(DB_PATH)
+    if before is not None:
+        rows = db.fetch_dicts(conn, f'''
+            SELECT id, source, log_message FROM {table_name}
+            WHERE target_label = ? AND id < ? ORDER BY id DESC LIMIT ?
+        ''', (label, before, FILTER_PAGE_SIZE + 1))
+        has_previous = len(rows) > FILTER_PAGE_SIZE
+        return rows[:FILTER_PAGE_SIZE][::-1], has_previous, True
+    rows = db.fetch_dicts(conn, f'''
+        SELECT id, source, log_message FROM {table_name}
+        WHERE target_label = ? AND id > ? ORDER BY id LIMIT ?
+    ''', (label, after or 0, FILTER_PAGE_SIZE + 1))
+    has_next = len(rows) > FILTER_PAGE_SIZE
+    return rows[:FILTER_PAGE_SIZE], after is not None, has_next
+
 @app.route('/filter/<label>')
 def filter_logs(label):
-    global temporary_results  # Use the global variable for non-logged-in users
     try:
-        if 'user' in session:
-            # Use the table_name from session if present
-            table_name = session.get('current_table_name')
-            if table_name:
-                conn = sqlite3.connect(DB_PATH)
-                df = pd.read_sql_query(
-                    f'SELECT source, log_message FROM {table_name} WHERE target_label = ?',
-                    conn, params=(label,))
-                conn.close()
-            else:
-                # fallback to previous logic (most recent upload)
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT table_name
-                    FROM uploads
-                    WHERE username = ?
-                    ORDER BY upload_date DESC
-                    LIMIT 1
-                ''', (session['user'],))
-                result = cursor.fetchone()
-                conn.close()
-                if not result:
-                    flash('No classification results found')
-                    return redirect(url_for('user_uploads'))
-                table_name = result[0]
-                conn = sqlite3.connect(DB_PATH)
-                df = pd.read_sql_query(
-                    f'SELECT source, log_message FROM {table_name} WHERE target_label = ?',
-                    conn, params=(label,))
-                conn.close()
-        else:
-            # Non-logged-in users: Use the session-stored results
-            df = None
-            if 'results' in session:
-                df = pd.read_json(session['results'], orient='split')
-            elif temporary_results is not None:
-                df = temporary_results
-            if df is None or df.empty:
-                flash('No classification results found')
-                return redirect(url_for('upload_file'))
-            
-            # Filter the temporary results for the selected label
-            df = df[df['target_label'] == label]
-
-        # Convert the filtered DataFrame to a list of dictionaries for rendering
-        filtered_logs = df.to_dict('records')
-
-        return render_template('filtered.html', logs=filtered_logs, label=label, user=session.get('user'))
+        table_name = get_results_table()
+        if not table_name:
+            flash('No classification results found')
+            return redirect(url_for('user_uploads' if 'user' in session else 'upload_file'))
+        total = get_classification_results(table_name)['label_counts'].get(label, 0)
+        filtered_logs, has_previous, has_next = get_filter_page(
+            table_name, label,
+            after=request.args.get('after', type=int),
+            before=request.args.get('before', type=int))
+
+        return render_template('filtered.html', logs=filtered_logs, label=label, total=total,
+                               has_previous=has_previous and bool(filtered_logs),
+                               has_next=has_next and bool(filtered_logs),
+                               user=session.get('user'))
     except Exception as e:
         print(f"Error filtering logs: {str(e)}")
         return str(e), 500
 
+@app.route('/filter/<label>/export')
+def export_logs(label):
+    """Stream every log with this label as CSV or NDJSON, a batch of rows at a time."""
+    table_name = get_results_table()
+    if not table_name:
+        flash('No classification results found')
+        return redirect(url_for('user_uploads' if 'user' in session else 'upload_file'))
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return 'Unsupported export format', 400
+
+    def batches():
+        table = columnar.open_table(table_name)
+        if table is not None:
+            yield from table.iter_rows(label, EXPORT_BATCH_SIZE)
+            return
+        cursor = db.connect(DB_PATH).execute(
+            f'SELECT source, log_message, target_label FROM {table_name} WHERE target_label = ? ORDER BY id',
+            (label,))
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+
+    def generate():
+        if export_format == 'csv':
+            yield 'source,log_message,target_label\r\n'
+        for rows in batches():
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows)
+                yield buffer.getvalue()
+            else:
+                yield ''.join(
+                    json.dumps({'source': source, 'log_message': log_message, 'target_label': target_label}) + '\n'
+                    for source, log_message, target_label in rows)
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f"{table_name}_{label.replace(' ', '_')}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text exposition format; each server process reports its own numbers
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/about')
 def about():
     return render_template('about.html', user=session.get('user'))
@@ -378,23 +450,9 @@ def internal_error(error):
 def not_found_error(error):
     return str(error), 404
 
-def clear_temporary_data():
-    """Clear any temporary data for non-logged-in users."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    try:
-        # Drop all temporary tables created for non-logged-in users
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'temp_%'")
-        temp_tables = cursor.fetchall()
-        for table in temp_tables:
-            cursor.execute(f"DROP TABLE IF EXISTS {table[0]}")
-        conn.commit()
-    finally:
-        conn.close()
-
 # Modify the bottom of the file to properly expose the Flask app
 def create_app():
-    clear_temporary_data()  # Clear temporary data on server start
+    # Anonymous users' results expire in the job pool, see jobs.clear_expired_results
     return app
 
 application = app
@@ -0,0 +1,273 @@
+"""Reproducible benchmarks of the classification pipeline.
+
+python benchmark.py --rows 10000,100000,1000000 --baseline benchmark_baseline.json
+
+Each tier and the end-to-end classify_csv run in a fresh process, so caches
+start cold and the peak RSS of one measurement does not leak into the next.
+The LLM tier always uses FakeClient, so the whole suite runs offline.
+"""
+import json
+import os
+import platform
+import random
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+SEED_PATH = "dataset/synthetic_logs.csv"
+DATA_DIR = os.getenv("BENCHMARK_DATA_DIR", "benchmark_data")  # generated CSVs are kept here and reused
+TIERS = ("lookup", "regex", "ml", "llm")
+# Lines timed one by one per tier; the slow tiers get smaller samples
+TIER_SAMPLE = {"lookup": 20000, "regex": 20000, "ml": 2000, "llm": 100}
+# A result regresses when it is this much worse than the baseline
+DEFAULT_TOLERANCE = 0.2
+
+_NUMBER = re.compile(r"\d+")
+
+
+def parse_mix(text):
+    """'ModernCRM=2,LegacyCRM=1' -> {'ModernCRM': 2.0, 'LegacyCRM': 1.0}"""
+    mix = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        source, _, weight = item.partition("=")
+        mix[source.strip()] = float(weight)
+    return mix
+
+
+def generate_logs(rows, source_mix=None, repeat_ratio=0.3, seed=0, seed_path=SEED_PATH):
+    """Synthetic logs shaped like synthetic_logs.csv (timestamp, source, log_message).
+
+    Messages are drawn from the seed file per source; repeat_ratio of them are
+    repeated verbatim, the rest get fresh numbers (IDs, IPs, timings) so they
+    share a template with a seed line without being identical to it.
+    source_mix maps sources to relative weights and defaults to the seed's own mix.
+    """
+    seed_logs = pd.read_csv(seed_path, usecols=["source", "log_message"])
+    by_source = {source: group.to_numpy() for source, group in seed_logs.groupby("source")["log_message"]}
+    if source_mix is None:
+        source_mix = seed_logs["source"].value_counts(normalize=True).to_dict()
+    unknown = set(source_mix) - set(by_source)
+    if unknown:
+        raise ValueError(f"No seed logs for source(s): {', '.join(sorted(unknown))}")
+
+    rng = np.random.default_rng(seed)
+    names = list(source_mix)
+    weights = np.array([source_mix[name] for name in names], dtype=float)
+    sources = np.array(names, dtype=object)[rng.choice(len(names), size=rows, p=weights / weights.sum())]
+    messages = np.empty(rows, dtype=object)
+    for name in names:
+        positions = np.flatnonzero(sources == name)
+        messages[positions] = by_source[name][rng.integers(0, len(by_source[name]), len(positions))]
+
+    digits = random.Random(seed)
+
+    def renumber(match):
+        return str(digits.randrange(10 ** len(match.group())))
+
+    fresh = np.flatnonzero(rng.random(rows) >= repeat_ratio)
+    messages[fresh] = [_NUMBER.sub(renumber, message) for message in messages[fresh]]
+
+    timestamps = pd.Timestamp("2025-01-01") + pd.to_timedelta(np.cumsum(rng.exponential(0.5, rows)), unit="s")
+    return pd.DataFrame({
+        "timestamp": timestamps.strftime("%Y-%m-%d %H:%M:%S"),
+        "source": sources,
+        "log_message": messages,
+    })
+
+
+def dataset_path(rows, source_mix=None, repeat_ratio=0.3, seed=0):
+    """Path of the generated CSV for these settings, generating it on first use."""
+    mix = ",".join(f"{source}={weight:g}" for source, weight in sorted((source_mix or {}).items())) or "seed"
+    name = f"logs_{rows}_{re.sub(r'[^A-Za-z0-9=.,]', '', mix)}_r{repeat_ratio:g}_s{seed}.csv"
+    path = os.path.join(DATA_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        generate_logs(rows, source_mix, repeat_ratio, seed).to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def _peak_rss_mb(children=False):
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+
+
+def _summary(lines, seconds, latencies_ns):
+    latencies_ms = np.asarray(latencies_ns, dtype=float) / 1e6
+    return {
+        "lines": lines,
+        "seconds": round(seconds, 4),
+        "lines_per_second": round(lines / seconds, 1) if seconds else None,
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 4) if len(latencies_ms) else None,
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 4) if len(latencies_ms) else None,
+    }
+
+
+def _time_lines(func, messages):
+    clock = time.perf_counter_ns
+    latencies = []
+    for message in messages:
+        started = clock()
+        func(message)
+        latencies.append(clock() - started)
+    return latencies
+
+
+def _run_tier(tier, csv_path):
+    # Runs in its own process: per-line latencies over a sample, throughput over
+    # the same sample through the batch API where the tier has one
+    logs = pd.read_csv(csv_path)
+    legacy = logs["source"] == "LegacyCRM"
+    messages = logs.loc[legacy if tier == "llm" else ~legacy, "log_message"].tolist()[:TIER_SAMPLE[tier]]
+    if not messages:
+        return {"lines": 0}
+
+    if tier == "lookup":
+        from process_lookup import classify_with_lookup, refresh
+        refresh()
+        latencies = _time_lines(classify_with_lookup, messages)
+        result = _summary(len(messages), sum(latencies) / 1e9, latencies)
+    elif tier == "regex":
+        from process_regex import classify_with_regex
+        latencies = _time_lines(classify_with_regex, messages)
+        result = _summary(len(messages), sum(latencies) / 1e9, latencies)
+    else:
+        if tier == "ml":
+            from process_ml import classify_with_ml, classify_with_ml_batch as classify_batch, load_models, ml_cache as cache
+            load_models()  # model loading is not part of the measurement
+            classify_line = classify_with_ml
+        else:
+            from process_LLM import classify_with_llm as classify_line, classify_with_llm_batch as classify_batch, llm_cache as cache
+        cache.clear()
+        latencies = _time_lines(classify_line, messages)
+        cache.clear()
+        started = time.perf_counter()
+        classify_batch(messages)
+        result = _summary(len(messages), time.perf_counter() - started, latencies)
+    result["peak_rss_mb"] = round(_peak_rss_mb(), 1)
+    return result
+
+
+def _run_end_to_end(csv_path, workers, chunksize):
+    # Per-line latency here is each chunk's time divided by its rows
+    from classify import classify_csv_chunks
+    from process_ml import load_models
+    load_models()
+    chunk_latencies = []
+    last = [time.perf_counter_ns(), 0]
+
+    def progress(rows_done, rows_per_second):
+        now = time.perf_counter_ns()
+        chunk_latencies.extend([(now - last[0]) / (rows_done - last[1])] * (rows_done - last[1]))
+        last[:] = [now, rows_done]
+
+    started = time.perf_counter()
+    # Chunks are dropped as they come, so peak RSS is that of streaming the file
+    rows = sum(len(chunk) for chunk in classify_csv_chunks(csv_path, chunksize, progress, workers))
+    result = _summary(rows, time.perf_counter() - started, chunk_latencies)
+    result["workers"] = workers
+    result["peak_rss_mb"] = round(_peak_rss_mb() + (_peak_rss_mb(children=True) if workers > 1 else 0), 1)
+    return result
+
+
+def _isolated(func, *args):
+    # A fresh interpreter per measurement; errors (e.g. a missing model) are recorded, not raised
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        try:
+            return pool.submit(func, *args).result()
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+
+def run_suite(row_counts, source_mix=None, repeat_ratio=0.3, seed=0, tiers=TIERS, workers=1, chunksize=None):
+    """Benchmark every tier and classify_csv at each row count; returns the results document."""
+    from classify import CSV_CHUNKSIZE
+    chunksize = chunksize or CSV_CHUNKSIZE
+    os.environ["LLM_BACKEND"] = "fake"  # inherited by the benchmark processes
+    os.environ.setdefault("LLM_FAKE_LATENCY", "0.05")
+    runs = {}
+    for rows in row_counts:
+        csv_path = dataset_path(rows, source_mix, repeat_ratio, seed)
+        for tier in tiers:
+            runs[f"{rows}/{tier}"] = _isolated(_run_tier, tier, csv_path)
+            print(f"{rows:>9} {tier:<12} {_format(runs[f'{rows}/{tier}'])}")
+        runs[f"{rows}/classify_csv"] = _isolated(_run_end_to_end, csv_path, workers, chunksize)
+        print(f"{rows:>9} {'classify_csv':<12} {_format(runs[f'{rows}/classify_csv'])}")
+    return {
+        "created": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "source_mix": source_mix, "repeat_ratio": repeat_ratio, "seed": seed, "workers": workers,
+            "chunksize": chunksize, "llm_fake_latency": float(os.environ["LLM_FAKE_LATENCY"]),
+        },
+        "runs": runs,
+    }
+
+
+def _format(result):
+    if "error" in result:
+        return f"error: {result['error']}"
+    if not result.get("lines"):
+        return "no lines for this tier"
+    return (f"{result['lines_per_second']:>12,.0f} lines/s  p50 {result['p50_ms']:.4f} ms  "
+            f"p99 {result['p99_ms']:.4f} ms  peak RSS {result['peak_rss_mb']:,.0f} MB")
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """List the runs that got slower or bigger than the baseline by more than tolerance."""
+    regressions = []
+    for key, current in results["runs"].items():
+        before = baseline.get("runs", {}).get(key)
+        if not before or "error" in current or "error" in before or not current.get("lines"):
+            continue
+        checks = (
+            ("lines_per_second", current.get("lines_per_second"), before.get("lines_per_second"), -1),
+            ("p99_ms", current.get("p99_ms"), before.get("p99_ms"), 1),
+            ("peak_rss_mb", current.get("peak_rss_mb"), before.get("peak_rss_mb"), 1),
+        )
+        for name, now, then, worse in checks:
+            if now is None or not then:
+                continue
+            change = (now - then) / then
+            if change * worse > tolerance:
+                regressions.append(f"{key} {name}: {then:,.4g} -> {now:,.4g} ({change:+.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the classification tiers and classify_csv on synthetic logs.")
+    parser.add_argument("--rows", default="10000", help="comma-separated row counts, e.g. 10000,100000,1000000")
+    parser.add_argument("--mix", type=parse_mix, default=None, help="source weights, e.g. ModernCRM=2,LegacyCRM=1 (default: the seed's mix)")
+    parser.add_argument("--repeat-ratio", type=float, default=0.3, help="share of lines repeated verbatim (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tiers", default=",".join(TIERS), help="tiers to benchmark on their own (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="classify_csv worker processes (default: %(default)s)")
+    parser.add_argument("--chunksize", type=int, default=None, help="classify_csv rows per chunk (default: CSV_CHUNKSIZE)")
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results JSON to compare against; regressions exit with status 1")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative slowdown (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = run_suite([int(rows) for rows in args.rows.split(",")], args.mix, args.repeat_ratio, args.seed,
+                        [tier for tier in args.tiers.split(",") if tier], args.workers, args.chunksize)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        print(f"{len(regressions)} regression(s) against {args.baseline}")
+        raise SystemExit(1 if regressions else 0)
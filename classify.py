@@ -1,41 +1,450 @@
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import metrics
+import process_lookup
+import process_ml
+import process_regex
+from process_lookup import classify_with_lookup, lookup_stats, remember, LOOKUP_MIN_CONFIDENCE
 from process_regex import classify_with_regex
-from process_ml import classify_with_ml
-from process_LLM import classify_with_llm
+from process_ml import classify_with_ml, classify_with_ml_batch, load_models, ml_cache
+from process_LLM import classify_with_llm, classify_with_llm_batch, get_client, llm_cache, llm_stats, PROMPT_VERSION
+
+
+def warm_up(ml=True, llm=True):
+    """Load the models up front instead of on first use.
+
+    Call it in a pre-fork server's master process so the workers share the
+    loaded models copy-on-write.
+    """
+    if ml:
+        load_models()
+    if llm:
+        get_client()
+
+
+TIERS = ("lookup", "regex", "ml", "llm")
+# Tiers classify() may use, e.g. CLASSIFY_TIERS=lookup,regex for an offline run;
+# logs only a disabled tier could answer are labelled "Unknown"
+ENABLED_TIERS = frozenset(filter(None, os.getenv("CLASSIFY_TIERS", ",".join(TIERS)).split(",")))
+
+def tier_versions():
+    """Version stamp for rows decided by each tier.
+
+    A stamp covers the deciding tier and every tier before it in the cascade,
+    since a new seed file or rule can take over rows from the tiers after it.
+    LegacyCRM rows only depend on the prompt.
+    """
+    parts = []
+    versions = {}
+    for tier, version in (("lookup", process_lookup.seed_version()),
+                          ("regex", process_regex.RULES_VERSION),
+                          ("ml", f"{process_ml.embedding_version()}:{process_ml.current_model_version()}:{process_ml.CONFIDENCE_THRESHOLD}")):
+        parts.append(f"{tier}={version}")
+        versions[tier] = hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+    versions["llm"] = hashlib.sha1(PROMPT_VERSION.encode()).hexdigest()[:16]
+    return versions
+
+
+def learned_version():
+    """Version the lookup tier's remembered ML answers are kept under: the ML tier's stamp."""
+    if "ml" not in ENABLED_TIERS:
+        return None  # nothing is remembered, and the model file need not exist
+    return tier_versions()["ml"]
+
+
+# How many distinct logs each tier classified, see tier_stats()
+_tier_counts = dict.fromkeys(TIERS, 0)
+_tier_lock = threading.Lock()
+
+
+def _count_tiers(**counts):
+    with _tier_lock:
+        for tier, count in counts.items():
+            _tier_counts[tier] += count
+
+
+def tier_stats():
+    with _tier_lock:
+        counts = dict(_tier_counts)
+    total = sum(counts.values())
+    return {tier: {'count': count, 'hit_ratio': count / total if total else 0.0} for tier, count in counts.items()}
+
+
+def _collect_stats():
+    # Counters kept by the tiers themselves, read only when /metrics is scraped
+    llm = llm_stats()
+    caches = {'ml': ml_cache.stats(), 'llm': llm_cache.stats()}
+    lookup = lookup_stats()
+    return [
+        ('log_classifier_logs_total', 'counter', 'Logs answered by each tier.',
+         [({'tier': tier}, stats['count']) for tier, stats in tier_stats().items()]),
+        ('log_classifier_cache_hits_total', 'counter', 'Label cache hits.',
+         [({'cache': name}, stats['hits']) for name, stats in caches.items()]),
+        ('log_classifier_cache_misses_total', 'counter', 'Label cache misses.',
+         [({'cache': name}, stats['misses']) for name, stats in caches.items()]),
+        ('log_classifier_cache_entries', 'gauge', 'Templates held in the in-memory label caches.',
+         [({'cache': name}, stats['size']) for name, stats in caches.items()]),
+        ('log_classifier_lookup_entries', 'gauge', 'Entries of the lookup index.',
+         [({'index': 'exact'}, lookup['exact_entries']), ({'index': 'template'}, lookup['template_entries']),
+          ({'index': 'learned'}, lookup['learned_entries'])]),
+        ('log_classifier_llm_events_total', 'counter', 'LLM requests, batched prompts, messages and invalid replies.',
+         [({'event': name}, llm[name]) for name in ('requests', 'batched_requests', 'messages', 'invalid_replies', 'individual_retries')]),
+    ]
+
+
+metrics.register_collector(_collect_stats)
+
+
+def _record(report):
+    # Tier counts, per-tier batch latency and threshold Unknowns of one classify() call
+    _count_tiers(**report['counts'])
+    for tier, seconds in report['seconds'].items():
+        metrics.TIER_SECONDS.observe(seconds, tier=tier)
+    if report['ml_unknown']:
+        metrics.ML_UNKNOWN.inc(report['ml_unknown'])
+    metrics.ROWS.inc(report['rows'])
+    metrics.DUPLICATE_ROWS.inc(report['rows'] - report['unique_rows'])
 
 
 def classify_log(source, log_msg):
     if source == "LegacyCRM":
         label = classify_with_llm(log_msg)
-    else:
-        label = classify_with_regex(log_msg)
-        if not label:
-            label = classify_with_ml(log_msg)
+        _count_tiers(llm=1)
+        return label
+    label = classify_with_lookup(log_msg, learned_version=learned_version())
+    if label:
+        _count_tiers(lookup=1)
+        return label
+    label = classify_with_regex(log_msg)
+    if label:
+        _count_tiers(regex=1)
+        return label
+    label = classify_with_ml(log_msg)
+    _count_tiers(ml=1)
+    if label == "Unknown":
+        metrics.ML_UNKNOWN.inc()
     return label
 
 
 
-def classify(logs):
-    labels = []
-    for source, log_msg in logs:
-        label = classify_log(source, log_msg)
-        labels.append(label)
+def classify(logs, return_tiers=False):
+    """Label (source, message) pairs; with return_tiers, also the tier that decided each label.
+
+    Answers the lookup tier remembered from the ML tier count as "ml"; labels
+    of a disabled tier have no deciding tier (None).
+    """
+    labels, report = _classify(logs)
+    _record(report)
+    if return_tiers:
+        return labels, report['tiers']
     return labels
 
 
-def classify_csv(input_file):
+def _classify(logs):
+    # Each distinct (source, message) pair goes through the tiers once; the
+    # labels are scattered back to every row that repeats it
+    positions = {}
+    inverse = np.fromiter((positions.setdefault((source, log_msg), len(positions)) for source, log_msg in logs),
+                          dtype=np.intp, count=len(logs))
+    if len(positions) == len(logs):
+        labels, report = _classify_unique(logs)
+    else:
+        labels, report = _classify_unique(list(positions))
+        labels = np.take(np.array(labels, dtype=object), inverse).tolist()
+        report['tiers'] = np.take(np.array(report['tiers'], dtype=object), inverse).tolist()
+    report['rows'], report['unique_rows'] = len(logs), len(positions)
+    return labels, report
+
+
+def _classify_unique(logs):
+    labels = [None] * len(logs)
+    tiers = [None] * len(logs)
+    lookup_hits = regex_hits = 0
+    lookup_seconds = regex_seconds = 0.0
+    clock = time.perf_counter
+
+    # Regex misses and LegacyCRM logs are collected and sent to their tier in one batch
+    ml_positions, ml_messages = [], []
+    llm_positions, llm_messages = [], []
+    use_lookup, use_regex = "lookup" in ENABLED_TIERS, "regex" in ENABLED_TIERS
+    learned = learned_version() if use_lookup else None
+    for i, (source, log_msg) in enumerate(logs):
+        if source == "LegacyCRM":
+            llm_positions.append(i)
+            llm_messages.append(log_msg)
+            continue
+        # Known messages and templates are answered straight from the lookup index
+        started = clock()
+        label, origin = classify_with_lookup(log_msg, True, learned) if use_lookup else (None, None)
+        looked_up = clock()
+        lookup_seconds += looked_up - started
+        if label:
+            labels[i] = label
+            tiers[i] = "lookup" if origin == "seed" else "ml"
+            lookup_hits += 1
+            continue
+        label = classify_with_regex(log_msg) if use_regex else None
+        regex_seconds += clock() - looked_up
+        if label:
+            labels[i] = label
+            tiers[i] = "regex"
+            regex_hits += 1
+        else:
+            ml_positions.append(i)
+            ml_messages.append(log_msg)
+
+    seconds = {}
+    if use_lookup and len(logs) > len(llm_positions):
+        seconds['lookup'] = lookup_seconds
+    if use_regex and len(logs) > len(llm_positions) + lookup_hits:
+        seconds['regex'] = regex_seconds
+    for tier, positions in (("ml", ml_positions), ("llm", llm_positions)):
+        if tier not in ENABLED_TIERS:
+            for i in positions:
+                labels[i] = "Unknown"
+            positions.clear()
+
+    ml_unknown = 0
+    if ml_positions:
+        started = clock()
+        confident = []
+        for i, (label, confidence) in zip(ml_positions, classify_with_ml_batch(ml_messages, return_confidence=True)):
+            labels[i] = label
+            tiers[i] = "ml"
+            if confidence is not None and confidence >= LOOKUP_MIN_CONFIDENCE:
+                confident.append(i)
+            elif label == "Unknown":
+                ml_unknown += 1
+        if use_lookup:
+            remember([logs[i][1] for i in confident], [labels[i] for i in confident], learned_version())
+        seconds['ml'] = clock() - started
+
+    if llm_positions:
+        started = clock()
+        for i, label in zip(llm_positions, classify_with_llm_batch(llm_messages)):
+            labels[i] = label
+            tiers[i] = "llm"
+        seconds['llm'] = clock() - started
+
+    report = {
+        'counts': {'lookup': lookup_hits, 'regex': regex_hits, 'ml': len(ml_positions), 'llm': len(llm_positions)},
+        'seconds': seconds,
+        'ml_unknown': ml_unknown,
+        'tiers': tiers,
+    }
+    return labels, report
+
+
+# Rows read from the input per chunk when classify_csv streams a file
+CSV_CHUNKSIZE = int(os.getenv("CSV_CHUNKSIZE", 10000))
+# Worker processes for classify_csv; 1 classifies in the calling process
+CLASSIFY_WORKERS = int(os.getenv("CLASSIFY_WORKERS", 1))
+CLASSIFY_START_METHOD = os.getenv("CLASSIFY_START_METHOD") or None  # multiprocessing start method, default for the OS
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _init_worker():
+    # Each worker process loads the ML model once, not once per chunk; workers
+    # without the ML tier, or sending it to the inference server, never import torch
+    if "ml" in ENABLED_TIERS and not process_ml.ML_SERVER_SOCKET:
+        load_models()
+
+
+def _classify_in_worker(logs):
+    # The parent records the report, so tier stats and metrics cover every worker
+    return _classify(logs)
+
+
+def _get_pool(workers):
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            import multiprocessing
+            context = multiprocessing.get_context(CLASSIFY_START_METHOD)
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker)
+            _pools[workers] = pool
+        return pool
+
+
+def _discard_pool(workers):
+    with _pools_lock:
+        pool = _pools.pop(workers, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Put in the chunks given to classify_batches when the input goes quiet: every
+# chunk submitted so far comes out before the next one is read
+FLUSH = object()
+
+
+def _label_chunks(chunks, workers):
+    """Yield (chunk, labels, report) in input order, sharding chunks across worker processes.
+
+    At most 2 * workers chunks are in flight; finished ones are yielded as soon
+    as every chunk before them is, and FLUSH waits for all of them. If a worker
+    dies, the chunks it left unfinished (and every later one) are classified in
+    this process.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            if chunk is FLUSH:
+                continue
+            labels, report = _classify(list(zip(chunk["source"], chunk["log_message"]))) #We send a list of tupples*** 
+            _record(report)
+            yield chunk, labels, report
+        return
+
+    pool = _get_pool(workers)
+    in_flight = deque()
+    broken = False
+    for chunk in chunks:
+        if chunk is FLUSH:
+            while in_flight:
+                broken = yield from _finish_oldest(in_flight, workers, broken)
+            continue
+        logs = list(zip(chunk["source"], chunk["log_message"]))
+        if not broken:
+            try:
+                in_flight.append((chunk, logs, pool.submit(_classify_in_worker, logs)))
+            except (BrokenProcessPool, RuntimeError):
+                broken = True
+        if broken:
+            in_flight.append((chunk, logs, None))
+        while in_flight and (len(in_flight) >= 2 * workers or in_flight[0][2] is None or in_flight[0][2].done()):
+            broken = yield from _finish_oldest(in_flight, workers, broken)
+    while in_flight:
+        broken = yield from _finish_oldest(in_flight, workers, broken)
+
+
+def classify_batches(batches, workers=CLASSIFY_WORKERS):
+    """Yield (batch, labels) for DataFrames with source and log_message columns, in input order.
+
+    batches may contain FLUSH to get every earlier batch back before the next one arrives.
+    """
+    for batch, labels, _ in _label_chunks(batches, workers):
+        yield batch, labels
+
+
+def _finish_oldest(in_flight, workers, broken):
+    chunk, logs, future = in_flight.popleft()
+    if future is not None:
+        try:
+            labels, report = future.result()
+            _record(report)
+            yield chunk, labels, report
+            return broken
+        except BrokenProcessPool:
+            if not broken:
+                print(f"A classification worker died, classifying the remaining chunks in process {os.getpid()}")
+                _discard_pool(workers)
+            broken = True
+    labels, report = _classify(logs)
+    _record(report)
+    yield chunk, labels, report
+    return broken
+
+
+# Columns classify_csv_chunks(provenance=True) adds: the deciding tier and its tier_versions() stamp
+PROVENANCE_COLUMNS = ("tier", "label_version")
+
+
+def classify_csv_chunks(input_file, chunksize=CSV_CHUNKSIZE, progress=None, workers=CLASSIFY_WORKERS, provenance=False,
+                        stats=None):
+    """Yield the input CSV as labelled DataFrame chunks of at most chunksize rows.
+
+    Peak memory is bounded by chunksize rather than by the size of the input.
+    progress, if given, is called after every chunk as progress(rows_done, rows_per_second).
+    With workers > 1, chunks are classified in a pool of that many processes.
+    With provenance, chunks also get the PROVENANCE_COLUMNS.
+    stats, if given, is a dict that receives the row count and the number of
+    rows left after de-duplicating each chunk ('rows', 'unique_rows').
+    """
     import pandas as pd
-    df = pd.read_csv(input_file)
+    started = time.perf_counter()
+    rows_done = 0
+
+    if stats is not None:
+        stats.update(rows=0, unique_rows=0)
+    for chunk, labels, report in _label_chunks(pd.read_csv(input_file, chunksize=chunksize), workers):
+        # Perform classification
+        chunk["target_label"] = labels
+        if provenance:
+            versions = tier_versions()
+            chunk["tier"] = report['tiers']
+            chunk["label_version"] = [versions.get(tier) for tier in report['tiers']]
+        if stats is not None:
+            stats['rows'] += report['rows']
+            stats['unique_rows'] += report['unique_rows']
+        rows_done += len(chunk)
+        if progress is not None:
+            elapsed = time.perf_counter() - started
+            progress(rows_done, rows_done / elapsed if elapsed else 0.0)
+        yield chunk
+
+    elapsed = time.perf_counter() - started
+    metrics.CSV_ROWS.inc(rows_done)
+    metrics.CSV_ROWS_PER_SECOND.set(rows_done / elapsed if elapsed else 0.0)
+
+    if rows_done == 0:
+        # Header-only input still yields one (empty) labelled frame
+        empty = pd.read_csv(input_file, nrows=0).assign(target_label=None)
+        yield empty.assign(tier=None, label_version=None) if provenance else empty
 
-    # Perform classification
-    df["target_label"] = classify(list(zip(df["source"], df["log_message"]))) #We send a list of tupples*** 
 
-    # Save the modified file
-    output_file = "dataset/output.csv"
-    df.to_csv(output_file, index=False)
+def classify_csv(input_file, output_file=None, chunksize=CSV_CHUNKSIZE, progress=None, workers=CLASSIFY_WORKERS):
+    """Classify a CSV into output_file chunk by chunk and return its path, or return a DataFrame without output_file.
 
+    Writing to output_file keeps no chunk once it is written, so peak memory
+    is bounded by chunksize rather than by the size of the input.
+    """
+    import pandas as pd
+    chunks = classify_csv_chunks(input_file, chunksize, progress, workers)
+    if not output_file:
+        return pd.concat(chunks, ignore_index=True)
+    for i, chunk in enumerate(chunks):
+        # Save the modified chunk, the first one replaces any previous output
+        chunk.to_csv(output_file, mode="w" if i == 0 else "a", header=i == 0, index=False)
     return output_file
 
+
+def _benchmark_workers(input_file, chunksize):
+    # Rows per second of classify_csv for 1, 2, 4, ... worker processes up to the core count
+    counts = [1]
+    while counts[-1] * 2 <= os.cpu_count():
+        counts.append(counts[-1] * 2)
+    print(f"{'workers':>8} {'rows/s':>12}")
+    for workers in counts:
+        if workers > 1:
+            _get_pool(workers).submit(_init_worker).result()  # start-up is not part of the measurement
+        started = time.perf_counter()
+        rows = sum(len(chunk) for chunk in classify_csv_chunks(input_file, chunksize, workers=workers))
+        print(f"{workers:>8} {rows / (time.perf_counter() - started):>12,.0f}")
+
+
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Classify the logs of a CSV with source and log_message columns.")
+    parser.add_argument("input_file", nargs="?", default="dataset/test.csv")
+    parser.add_argument("-o", "--output", default="dataset/output.csv")
+    parser.add_argument("--workers", type=int, default=CLASSIFY_WORKERS, help="worker processes (default: %(default)s)")
+    parser.add_argument("--chunksize", type=int, default=CSV_CHUNKSIZE, help="rows per chunk (default: %(default)s)")
+    parser.add_argument("--benchmark", action="store_true", help="report rows/s for 1, 2, 4, ... workers instead")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        _benchmark_workers(args.input_file, args.chunksize)
+        raise SystemExit
+
     logs = [
         ("ModernHR", "Privilege escalation warning detected for user 6482"),
         ("LegacyCRM", "Case update for ticket ID 8247 failed as the assigned representative is no longer active."),
@@ -54,7 +463,11 @@ if __name__ == '__main__':
     for log, label in zip(logs, labels):
         print(log[0], "->", label)
         
-    output_file = classify_csv("dataset/test.csv")
+    def print_progress(rows_done, rows_per_second):
+        print(f"{rows_done} rows classified ({rows_per_second:,.0f} rows/s)")
+
+    output_file = args.output
+    classify_csv(args.input_file, output_file, chunksize=args.chunksize, progress=print_progress, workers=args.workers)
     try:
         with open(output_file) as f:
             print(f"Classification results saved to: {output_file}")
@@ -0,0 +1,237 @@
+"""Classify logs from files or stdin and stream the labelled records out.
+
+    tail -F app.log | python cli.py --format tsv --max-wait 1
+    python cli.py logs.csv more.ndjson -o labelled.ndjson --output-format ndjson
+
+Input is CSV (source and log_message columns), NDJSON (objects with source
+and log_message) or raw "source<TAB>message" lines. Records are classified in
+batches of --batch-size, or whatever has arrived after --max-wait seconds, and
+written as soon as their batch is done.
+"""
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+
+FORMATS = ("csv", "ndjson", "tsv")
+_END = object()
+
+
+def detect_format(path, first_line):
+    """Pick the input format from the file extension, or from the first line for stdin."""
+    extension = os.path.splitext(path)[1].lower() if path != "-" else ""
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl", ".json"):
+        return "ndjson"
+    if extension in (".tsv", ".log", ".txt"):
+        return "tsv"
+    if first_line.lstrip().startswith("{"):
+        return "ndjson"
+    return "tsv" if "\t" in first_line else "csv"
+
+
+def read_records(stream, input_format, errors=sys.stderr):
+    """Yield one dict per record; records without a log message are reported and skipped."""
+    lines = (line for line in stream if line.strip())
+    if input_format == "csv":
+        lines = csv.DictReader(lines)
+    for number, item in enumerate(lines, 1):
+        try:
+            if input_format == "csv":
+                record = item
+            elif input_format == "ndjson":
+                record = json.loads(item)
+                if not isinstance(record, dict):
+                    raise ValueError("not a JSON object")
+            else:
+                source, _, message = item.rstrip("\r\n").partition("\t")
+                record = {"source": source, "log_message": message} if message else {"source": "", "log_message": source}
+            if not isinstance(record.get("log_message"), str):
+                raise ValueError("no log_message")
+        except ValueError as e:
+            print(f"Skipping record {number}: {e}", file=errors)
+            continue
+        yield record
+
+
+def _read_inputs(paths, input_format, records, failures):
+    # Reader thread: feeds records into the queue so batches can be cut by time as well as size
+    try:
+        for path in paths:
+            try:
+                stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+            except OSError as e:
+                print(f"Cannot read {path}: {e}", file=sys.stderr)
+                failures.append(path)
+                continue
+            try:
+                first_line = stream.readline()
+                file_format = input_format if input_format != "auto" else detect_format(path, first_line)
+                for record in read_records(_chain(first_line, stream), file_format):
+                    records.put(record)
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+    finally:
+        records.put(_END)
+
+
+def _chain(first_line, stream):
+    yield first_line
+    yield from stream
+
+
+def batch_records(records, batch_size, max_wait):
+    """Yield lists of records from the queue: batch_size of them, or fewer once max_wait has passed.
+
+    An empty list means nothing arrived for max_wait after the last batch.
+    """
+    done = False
+    while not done:
+        try:
+            item = records.get(timeout=max_wait)
+        except queue.Empty:
+            yield []  # the input is idle, batches still being classified should come out
+            item = records.get()
+        if item is _END:
+            return
+        batch = [item]
+        deadline = time.monotonic() + max_wait
+        while len(batch) < batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = records.get(timeout=timeout) if timeout > 0 else records.get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                done = True
+                break
+            batch.append(item)
+        yield batch
+
+
+class RecordWriter:
+    """Writes labelled records in one of FORMATS, flushing after every batch."""
+
+    def __init__(self, stream, output_format):
+        self.stream = stream
+        self.format = output_format
+        self._csv = None
+
+    def write(self, records):
+        if self.format == "ndjson":
+            self.stream.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        elif self.format == "tsv":
+            self.stream.writelines(
+                f"{record.get('source') or ''}\t{_one_line(record['log_message'])}\t{record['target_label']}\n"
+                for record in records)
+        else:
+            if self._csv is None:
+                # The first record decides the columns, target_label always comes last
+                fields = [name for name in records[0] if name != "target_label"] + ["target_label"]
+                self._csv = csv.DictWriter(self.stream, fieldnames=fields, extrasaction="ignore")
+                self._csv.writeheader()
+            self._csv.writerows(records)
+        self.stream.flush()
+
+
+def _one_line(text):
+    return text.replace("\t", " ").replace("\n", " ")
+
+
+def run(paths, output, input_format="auto", output_format=None, batch_size=1000, max_wait=1.0, workers=1, quiet=False):
+    """Classify every record of paths into output; returns (records written, paths that could not be read)."""
+    import pandas as pd
+    from classify import FLUSH, classify_batches
+
+    records = queue.Queue(maxsize=batch_size * max(2, 2 * workers))  # backpressure on the reader
+    failures = []
+    threading.Thread(target=_read_inputs, args=(paths, input_format, records, failures), daemon=True).start()
+
+    if output_format is None:
+        output_format = input_format if input_format != "auto" else "ndjson"
+    writer = RecordWriter(output, output_format)
+    pending = deque()
+    rows = 0
+    started = time.perf_counter()
+
+    def frames():
+        for batch in batch_records(records, batch_size, max_wait):
+            if not batch:
+                yield FLUSH
+                continue
+            pending.append(batch)
+            yield pd.DataFrame({
+                "source": [record.get("source") for record in batch],
+                "log_message": [record["log_message"] for record in batch],
+            })
+
+    for _, labels in classify_batches(frames(), workers):
+        batch = pending.popleft()
+        for record, label in zip(batch, labels):
+            record["target_label"] = label
+        writer.write(batch)
+        rows += len(batch)
+
+    if not quiet:
+        elapsed = time.perf_counter() - started
+        print(f"{rows} records classified in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:,.0f} records/s)",
+              file=sys.stderr)
+    return rows, failures
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Classify logs from files or stdin, streaming labelled records out.")
+    parser.add_argument("inputs", nargs="*", default=["-"], help="input files, - for stdin (default)")
+    parser.add_argument("-o", "--output", default="-", help="output file, - for stdout (default)")
+    parser.add_argument("-f", "--format", choices=("auto",) + FORMATS, default="auto",
+                        help="input format (default: from the extension, or sniffed from the first line)")
+    parser.add_argument("--output-format", choices=FORMATS, help="default: the input format, ndjson when detected")
+    parser.add_argument("--batch-size", type=int, default=1000, help="records per batch (default: %(default)s)")
+    parser.add_argument("--max-wait", type=float, default=1.0,
+                        help="seconds to wait for a batch to fill before classifying what has arrived (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (default: %(default)s)")
+    parser.add_argument("--tiers", help="comma-separated tiers to use, out of lookup,regex,ml,llm (default: all)")
+    parser.add_argument("--cache", help="SQLite file for the ML and LLM label caches (default: in memory only)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no summary on stderr")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    # The tiers read these at import time, in this process and in every worker,
+    # so they are set before classify is imported
+    if args.tiers:
+        os.environ["CLASSIFY_TIERS"] = args.tiers
+    if args.cache:
+        os.environ["ML_CACHE_PATH"] = os.environ["LLM_CACHE_PATH"] = args.cache
+    from classify import TIERS
+    unknown = set(filter(None, (args.tiers or "").split(","))) - set(TIERS)
+    if unknown:
+        raise SystemExit(f"Unknown tier(s): {', '.join(sorted(unknown))}; choose from {','.join(TIERS)}")
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    try:
+        _, failures = run(args.inputs, output, args.format, args.output_format, args.batch_size, args.max_wait,
+                          args.workers, args.quiet)
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head); silence the flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        raise SystemExit(1)
+    except KeyboardInterrupt:
+        raise SystemExit(130)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""Columnar storage for classified uploads, an alternative to one SQLite table per upload.
+
+A table is a directory under RESULTS_DIR:
+
+    meta.json      row count, the source and label dictionaries and each label's span of order.npy
+    source.npy     dictionary code of every row's source (-1 when missing)
+    label.npy      dictionary code of every row's label (-1 when missing)
+    tier.npy, label_version.npy
+                   dictionary codes of the provenance columns, when the chunks had them
+    order.npy      row positions grouped by label, ascending within each label
+    messages.bin   log messages, zlib-compressed JSON arrays of BLOCK_ROWS messages each
+    blocks.npy     byte offset of every block in messages.bin, plus the end
+
+The arrays are memory-mapped, so label counts and filter pages only touch the
+codes and the message blocks of the rows they show. Row ids are 1-based like
+the SQLite tables' ids, so the same keyset links work for both.
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+RESULTS_DIR = os.getenv("RESULTS_DIR", "results")
+BLOCK_ROWS = int(os.getenv("COLUMNAR_BLOCK_ROWS", 256))  # messages per compressed block
+EXTRA_COLUMNS = ("tier", "label_version")  # optional dictionary-encoded columns
+
+
+def table_path(table_name):
+    if not table_name or os.path.basename(table_name) != table_name or table_name.startswith("."):
+        raise ValueError(f"Invalid table name: {table_name!r}")
+    return os.path.join(RESULTS_DIR, table_name)
+
+
+def exists(table_name):
+    return os.path.exists(os.path.join(table_path(table_name), "meta.json"))
+
+
+def drop_table(table_name):
+    shutil.rmtree(table_path(table_name), ignore_errors=True)
+
+
+def _code_dtype(size):
+    # The smallest signed type that holds every code and the -1 for missing values
+    for dtype in (np.int8, np.int16, np.int32):
+        if size < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class _Dictionary:
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def encode(self, values):
+        codes = self._codes
+        for value in values:
+            if isinstance(value, str) and value not in codes:
+                codes[value] = len(self.values)
+                self.values.append(value)
+        return [codes.get(value, -1) if isinstance(value, str) else -1 for value in values]
+
+
+def write_table(table_name, chunks):
+    """Store labelled DataFrame chunks (source, log_message, target_label) as a columnar table.
+
+    The table appears atomically once complete. Returns the label summary as
+    [(label, count, first_id)] in order of first appearance.
+    """
+    final_path = table_path(table_name)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = f"{final_path}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(path)
+    try:
+        sources, labels = _Dictionary(), _Dictionary()
+        source_codes, label_codes = [], []
+        extras = {}  # column -> (dictionary, codes)
+        # Messages are spooled to one file per label, then written out grouped by
+        # label, so a filter page reads one or two neighbouring blocks
+        spools = {}
+        for chunk in chunks:
+            source_codes.extend(sources.encode(chunk["source"].tolist()))
+            codes = labels.encode(chunk["target_label"].tolist())
+            label_codes.extend(codes)
+            for column in EXTRA_COLUMNS:
+                if column in chunk:
+                    dictionary, column_codes = extras.setdefault(column, (_Dictionary(), [-1] * (len(label_codes) - len(codes))))
+                    column_codes.extend(dictionary.encode(chunk[column].tolist()))
+            for column, (_, column_codes) in extras.items():
+                column_codes.extend([-1] * (len(label_codes) - len(column_codes)))
+            for code, message in zip(codes, chunk["log_message"].tolist()):
+                spool = spools.get(code)
+                if spool is None:
+                    spool = spools[code] = open(os.path.join(path, f"spool_{code}.ndjson"), "w+", encoding="utf-8")
+                spool.write(json.dumps(message if isinstance(message, str) else None, ensure_ascii=False) + "\n")
+
+        block_offsets = [0]
+        with open(os.path.join(path, "messages.bin"), "wb") as messages:
+            block = []
+
+            def flush():
+                data = zlib.compress(("[" + ",".join(block) + "]").encode("utf-8"))
+                messages.write(data)
+                block_offsets.append(block_offsets[-1] + len(data))
+                block.clear()
+
+            for code in sorted(spools):
+                spool = spools.pop(code)
+                spool.seek(0)
+                for line in spool:
+                    block.append(line.rstrip("\n"))
+                    if len(block) == BLOCK_ROWS:
+                        flush()
+                spool.close()
+                os.remove(spool.name)
+            if block:
+                flush()
+
+        label_array = np.array(label_codes, dtype=_code_dtype(len(labels.values)))
+        order = np.argsort(label_array, kind="stable").astype(_code_dtype(len(label_array)))
+        starts = np.searchsorted(label_array[order], np.arange(len(labels.values) + 1))
+        np.save(os.path.join(path, "source.npy"), np.array(source_codes, dtype=_code_dtype(len(sources.values))))
+        np.save(os.path.join(path, "label.npy"), label_array)
+        np.save(os.path.join(path, "order.npy"), order)
+        np.save(os.path.join(path, "blocks.npy"), np.array(block_offsets, dtype=np.int64))
+        for column, (dictionary, column_codes) in extras.items():
+            np.save(os.path.join(path, f"{column}.npy"), np.array(column_codes, dtype=_code_dtype(len(dictionary.values))))
+        meta = {
+            "rows": len(label_array),
+            "block_rows": BLOCK_ROWS,
+            "sources": sources.values,
+            "labels": labels.values,
+            "label_spans": {label: [int(starts[code]), int(starts[code + 1])] for code, label in enumerate(labels.values)},
+            "extra_values": {column: dictionary.values for column, (dictionary, _) in extras.items()},
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        drop_table(table_name)
+        os.replace(path, final_path)
+    except BaseException:
+        for spool in spools.values():
+            spool.close()
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    return open_table(table_name).summary()
+
+
+class ColumnarTable:
+    """Read side of a columnar table; every array is memory-mapped."""
+
+    BLOCK_CACHE_SIZE = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.block_rows = meta["block_rows"]
+        self.sources = meta["sources"]
+        self.labels = meta["labels"]
+        self.label_spans = meta["label_spans"]
+        self._source = np.load(os.path.join(path, "source.npy"), mmap_mode="r")
+        self._label = np.load(os.path.join(path, "label.npy"), mmap_mode="r")
+        self._order = np.load(os.path.join(path, "order.npy"), mmap_mode="r")
+        self._blocks = np.load(os.path.join(path, "blocks.npy"), mmap_mode="r")
+        self._extras = {column: (values, np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r"))
+                        for column, values in meta.get("extra_values", {}).items()}
+        self._block_cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def summary(self):
+        """[(label, count, first_id)] in order of first appearance, like summarize_table()."""
+        rows = [(label, end - start, int(self._order[start]) + 1)
+                for label, (start, end) in self.label_spans.items() if end > start]
+        return sorted(rows, key=lambda row: row[2])
+
+    def label_counts(self):
+        return {label: count for label, count, _ in self.summary()}
+
+    def _messages(self, block):
+        with self._lock:
+            if block in self._block_cache:
+                self._block_cache.move_to_end(block)
+                return self._block_cache[block]
+        with open(os.path.join(self.path, "messages.bin"), "rb") as f:
+            f.seek(int(self._blocks[block]))
+            data = f.read(int(self._blocks[block + 1] - self._blocks[block]))
+        messages = json.loads(zlib.decompress(data))
+        with self._lock:
+            self._block_cache[block] = messages
+            while len(self._block_cache) > self.BLOCK_CACHE_SIZE:
+                self._block_cache.popitem(last=False)
+        return messages
+
+    def _rows(self, start, end):
+        # Rows at order[start:end]; their messages sit in the same slots of messages.bin
+        positions = self._order[start:end].tolist()
+        rows = []
+        for slot, position in zip(range(start, end), positions):
+            source, label = int(self._source[position]), int(self._label[position])
+            rows.append({
+                "id": position + 1,
+                "source": self.sources[source] if source >= 0 else None,
+                "log_message": self._messages(slot // self.block_rows)[slot % self.block_rows],
+                "target_label": self.labels[label] if label >= 0 else None,
+            })
+        return rows
+
+    def iter_frames(self, batch_size=10000):
+        """Yield the whole table as DataFrames in id order, with the same columns it was written with."""
+        import pandas as pd
+        slots_by_position = np.empty(self.rows, dtype=np.int64)
+        slots_by_position[self._order] = np.arange(self.rows)
+        for start in range(0, self.rows, batch_size):
+            end = min(start + batch_size, self.rows)
+            slots = slots_by_position[start:end].tolist()
+            frame = {
+                "id": np.arange(start + 1, end + 1),
+                "source": _decode(self.sources, self._source[start:end]),
+                "log_message": [self._messages(slot // self.block_rows)[slot % self.block_rows] for slot in slots],
+                "target_label": _decode(self.labels, self._label[start:end]),
+            }
+            for column, (values, codes) in self._extras.items():
+                frame[column] = _decode(values, codes[start:end])
+            yield pd.DataFrame(frame)
+
+    def page(self, label, size, after=None, before=None):
+        """Keyset page of a label's rows, like app.get_filter_page: (rows, has_previous, has_next)."""
+        first, last = self.label_spans.get(label, (0, 0))
+        positions = self._order[first:last]
+        if before is not None:
+            end = first + int(np.searchsorted(positions, before - 1))  # ids below before
+            start = max(first, end - size)
+            return self._rows(start, end), start > first, True
+        start = first + (int(np.searchsorted(positions, after)) if after else 0)  # ids above after
+        end = min(start + size, last)
+        return self._rows(start, end), after is not None, end < last
+
+    def iter_rows(self, label, batch_size=1000):
+        """Yield batches of (source, log_message, target_label) for every row with label, in id order."""
+        first, last = self.label_spans.get(label, (0, 0))
+        for start in range(first, last, batch_size):
+            yield [(row["source"], row["log_message"], row["target_label"])
+                   for row in self._rows(start, min(start + batch_size, last))]
+
+
+def _decode(values, codes):
+    return [values[code] if code >= 0 else None for code in np.asarray(codes).tolist()]
+
+
+# Open tables by path, reused while their meta.json is the same file
+_open_tables = OrderedDict()
+_open_lock = threading.Lock()
+OPEN_TABLES = 32
+
+
+def open_table(table_name):
+    """The columnar table stored under this name, or None if it is kept in SQLite."""
+    try:
+        path = table_path(table_name)
+        stat = os.stat(os.path.join(path, "meta.json"))
+    except (ValueError, OSError):
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns)
+    with _open_lock:
+        cached = _open_tables.get(path)
+        if cached is not None and cached[0] == key:
+            _open_tables.move_to_end(path)
+            return cached[1]
+    table = ColumnarTable(path)
+    with _open_lock:
+        _open_tables[path] = (key, table)
+        _open_tables.move_to_end(path)
+        while len(_open_tables) > OPEN_TABLES:
+            _open_tables.popitem(last=False)
+    return table
+
+
+def _benchmark(rows=200000, page_size=50):
+    # Disk footprint and filter-page time of a columnar table against the SQLite table store_chunks writes
+    import sqlite3
+    import tempfile
+    import time
+    from benchmark import generate_logs
+    import jobs
+
+    global RESULTS_DIR
+    logs = generate_logs(rows)
+    # Labels that follow the messages, as the lookup tier would assign them
+    from process_lookup import classify_with_lookup
+    logs["target_label"] = [classify_with_lookup(message) or "Unknown" for message in logs["log_message"]]
+    rare_label = logs["target_label"].value_counts().index[-1]
+    chunks = [logs.iloc[start:start + 10000] for start in range(0, rows, 10000)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        RESULTS_DIR = directory
+        conn = sqlite3.connect(os.path.join(directory, "results.db"))
+        conn.execute("CREATE TABLE upload_label_counts (table_name TEXT, target_label TEXT, count INTEGER, first_id INTEGER)")
+        started = time.perf_counter()
+        jobs.store_chunks(conn, "logs", chunks)
+        sqlite_write = time.perf_counter() - started
+        conn.execute("VACUUM")
+        sqlite_bytes = os.path.getsize(os.path.join(directory, "results.db"))
+        started = time.perf_counter()
+        write_table("logs", chunks)
+        columnar_write = time.perf_counter() - started
+        columnar_bytes = sum(entry.stat().st_size for entry in os.scandir(table_path("logs")))
+
+        def sqlite_page(label, after):
+            return conn.execute("SELECT id, source, log_message FROM logs WHERE target_label = ? AND id > ? ORDER BY id LIMIT ?",
+                                (label, after, page_size + 1)).fetchall()
+
+        def columnar_page(label, after):
+            table = open_table("logs")
+            table._block_cache.clear()  # every page decompresses its blocks
+            return table.page(label, page_size, after)
+
+        print(f"{rows:,} rows, {len(logs['target_label'].unique())} labels")
+        print(f"{'':>10} {'bytes':>12} {'write s':>8} {'first page ms':>14} {'deep page ms':>13} {'rare label ms':>14}")
+        for name, size, write_seconds, page in (("sqlite", sqlite_bytes, sqlite_write, sqlite_page),
+                                                ("columnar", columnar_bytes, columnar_write, columnar_page)):
+            timings = []
+            for label, after in ((logs["target_label"].iloc[0], 0), (logs["target_label"].iloc[0], rows // 2), (rare_label, rows // 2)):
+                started = time.perf_counter()
+                for _ in range(20):
+                    page(label, after)
+                timings.append((time.perf_counter() - started) / 20 * 1000)
+            print(f"{name:>10} {size:>12,} {write_seconds:>8.2f} {timings[0]:>14.3f} {timings[1]:>13.3f} {timings[2]:>14.3f}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,42 @@
+import os
+import sqlite3
+import threading
+
+# Applied to every new connection. WAL lets dashboard reads run alongside an
+# upload being written; busy_timeout makes writers wait instead of failing
+# with "database is locked".
+PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64000)),  # negative means KiB, so 64MB
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'temp_store': 'MEMORY',
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 30000)),
+}
+
+_local = threading.local()
+
+
+def connect(db_path):
+    """Return this thread's connection to db_path, opening and tuning it on first use.
+
+    Connections are reused for the life of the thread (and reopened after a
+    fork), so callers must not close them. Wrap writes in `with conn:` so
+    they commit, or roll back on error, before the connection is reused.
+    """
+    connections = _local.__dict__.setdefault('connections', {})
+    key = (db_path, os.getpid())
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=PRAGMAS['busy_timeout'] / 1000)
+        for name, value in PRAGMAS.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        connections[key] = conn
+    return conn
+
+
+def fetch_dicts(conn, query, params=()):
+    """Run a query and return its rows as dicts, without changing the shared connection's row_factory."""
+    cursor = conn.execute(query, params)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
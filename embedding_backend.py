@@ -0,0 +1,240 @@
+"""Embedding backends for the ML tier, chosen with EMBEDDING_BACKEND (see process_ml).
+
+- 'torch': SentenceTransformer in full precision;
+- 'int8': the same model with its Linear layers dynamically quantized to int8;
+  both load the local model directory when export() wrote one there;
+- 'onnx', 'onnx-int8': an ONNX export of the transformer run by onnxruntime,
+  with mean pooling done in numpy, loaded from a local model directory.
+
+    python embedding_backend.py export models/minilm     # ONNX files (fp32 and int8) for the onnx backends
+    python embedding_backend.py parity --backend onnx-int8
+    python embedding_backend.py bench --threads 1
+"""
+import json
+import os
+
+import numpy as np
+
+BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+
+
+def load_encoder(backend, model_name, model_dir, max_seq_length=0, threads=0):
+    """Return an object with SentenceTransformer's encode(sentences, batch_size=...) for backend.
+
+    max_seq_length and threads of 0 keep the model's and the runtime's defaults.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend!r}, choose from {', '.join(BACKENDS)}")
+    if backend in ONNX_FILES:
+        return OnnxEncoder(model_dir, ONNX_FILES[backend], max_seq_length, threads)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if threads:
+        torch.set_num_threads(threads)
+    # The exported directory holds the same weights as the onnx files, and needs no download
+    if model_dir and os.path.exists(os.path.join(model_dir, "modules.json")):
+        model_name = model_dir
+    model = SentenceTransformer(model_name, device="cpu")
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+    if backend == "int8":
+        # Weights are stored as int8 and activations quantized on the fly, the
+        # attention and feed-forward matmuls are where the time goes on CPU
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+class OnnxEncoder:
+    """MiniLM sentence embeddings from an onnxruntime session.
+
+    model_dir holds the ONNX file, tokenizer.json and the sentence-transformers
+    modules.json, as written by export(). Sentences are tokenized first and
+    batched by token count, so each batch is only padded to its longest one.
+    """
+
+    def __init__(self, model_dir, filename="model.onnx", max_seq_length=0, threads=0):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, filename), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+        config = _read_json(os.path.join(model_dir, "sentence_bert_config.json"), {})
+        self.max_seq_length = max_seq_length or config.get("max_seq_length", 256)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.max_seq_length)
+        self.tokenizer.no_padding()  # _encode_batch pads each batch itself
+        self.pad_id = self.tokenizer.token_to_id("[PAD]") or 0
+        modules = _read_json(os.path.join(model_dir, "modules.json"), [])
+        self.normalize = any(module["type"].endswith("Normalize") for module in modules)
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size)[0]
+        embeddings = None
+        encodings = self.tokenizer.encode_batch(list(sentences))
+        order = np.argsort([-len(encoding.ids) for encoding in encodings], kind="stable")
+        for start in range(0, len(sentences), batch_size):
+            indices = order[start:start + batch_size]
+            batch = self._encode_batch([encodings[i] for i in indices])
+            if embeddings is None:
+                embeddings = np.empty((len(sentences), batch.shape[1]), dtype=np.float32)
+            embeddings[indices] = batch
+        return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
+
+    def _encode_batch(self, encodings):
+        length = max(len(encoding.ids) for encoding in encodings)
+        feed = {
+            "input_ids": np.full((len(encodings), length), self.pad_id, dtype=np.int64),
+            "attention_mask": np.zeros((len(encodings), length), dtype=np.int64),
+            "token_type_ids": np.zeros((len(encodings), length), dtype=np.int64),
+        }
+        for row, encoding in enumerate(encodings):
+            size = len(encoding.ids)
+            feed["input_ids"][row, :size] = encoding.ids
+            feed["attention_mask"][row, :size] = encoding.attention_mask
+            feed["token_type_ids"][row, :size] = encoding.type_ids
+        hidden = self.session.run(None, {name: value for name, value in feed.items() if name in self.input_names})[0]
+        # Mean pooling over the real tokens, as in the model's 1_Pooling config
+        mask = feed["attention_mask"][:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.normalize:
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled
+
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def export(model_name, model_dir, opset=14):
+    """Save model_name to model_dir with an ONNX export of its transformer and an int8-quantized copy."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    # The sentence-transformers files let the torch backends load offline from the same directory
+    model.save(model_dir)
+    transformer = model[0].auto_model.eval()
+    sample = model.tokenizer(["an example log message"], return_tensors="pt")
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    axes = {name: {0: "batch", 1: "tokens"} for name in names}
+    axes["last_hidden_state"] = {0: "batch", 1: "tokens"}
+    with torch.no_grad():
+        torch.onnx.export(transformer, tuple(sample[name] for name in names), os.path.join(model_dir, ONNX_FILES["onnx"]),
+                          input_names=names, output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=opset)
+    quantize_dynamic(os.path.join(model_dir, ONNX_FILES["onnx"]), os.path.join(model_dir, ONNX_FILES["onnx-int8"]),
+                     weight_type=QuantType.QInt8)
+
+
+def _messages(csv_path="dataset/synthetic_logs.csv"):
+    # What the ML tier sees: LegacyCRM goes to the LLM instead
+    import pandas as pd
+    logs = pd.read_csv(csv_path)
+    return logs.loc[logs["source"] != "LegacyCRM", "log_message"].tolist()
+
+
+def parity(backend, reference="torch", csv_path="dataset/synthetic_logs.csv"):
+    """Compare backend's KNN labels and embeddings with reference's on the dataset; returns a dict."""
+    import process_ml
+
+    messages = _messages(csv_path)
+    embeddings = {}
+    for name, max_seq_length in ((reference, 0), (backend, process_ml.EMBEDDING_MAX_SEQ_LENGTH)):
+        encoder = load_encoder(name, process_ml.EMBEDDING_MODEL, process_ml.EMBEDDING_MODEL_DIR,
+                               max_seq_length, process_ml.EMBEDDING_THREADS)
+        embeddings[name] = np.asarray(encoder.encode(messages, batch_size=process_ml.ML_BATCH_SIZE), dtype=np.float32)
+    expected, _ = process_ml._predict(embeddings[reference])
+    got, _ = process_ml._predict(embeddings[backend])
+    a, b = embeddings[reference], embeddings[backend]
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    differing = [(message, old, new) for message, old, new in zip(messages, expected, got) if old != new]
+    return {
+        "messages": len(messages),
+        "label_agreement": round(1 - len(differing) / len(messages), 4),
+        "min_cosine": round(float(cosine.min()), 4),
+        "mean_cosine": round(float(cosine.mean()), 4),
+        "differing": differing[:10],
+    }
+
+
+def _run_backend(backend, messages, batch_size, max_seq_length, threads):
+    # Runs in its own process so peak RSS belongs to one backend
+    import time
+    import process_ml
+    from benchmark import _peak_rss_mb
+
+    started = time.perf_counter()
+    encoder = load_encoder(backend, process_ml.EMBEDDING_MODEL, process_ml.EMBEDDING_MODEL_DIR, max_seq_length, threads)
+    load_seconds = time.perf_counter() - started
+    encoder.encode(messages[:batch_size], batch_size=batch_size)  # warm-up
+    started = time.perf_counter()
+    encoder.encode(messages, batch_size=batch_size)
+    seconds = time.perf_counter() - started
+    return {
+        "backend": backend,
+        "load_seconds": round(load_seconds, 2),
+        "encodes_per_second": round(len(messages) / seconds, 1),
+        "encodes_per_second_per_thread": round(len(messages) / seconds / (threads or os.cpu_count()), 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def bench(backends=BACKENDS, csv_path="dataset/synthetic_logs.csv", batch_size=64, max_seq_length=0, threads=1):
+    """Encode throughput and peak RSS of each backend, each in a fresh process."""
+    from benchmark import _isolated
+    messages = _messages(csv_path)
+    return [dict(_isolated(_run_backend, backend, messages, batch_size, max_seq_length, threads), backend=backend)
+            for backend in backends]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import process_ml
+
+    parser = argparse.ArgumentParser(description="Export, check and benchmark the ML tier's embedding backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the ONNX models for the onnx backends")
+    export_parser.add_argument("model_dir", nargs="?", default=process_ml.EMBEDDING_MODEL_DIR)
+    export_parser.add_argument("--model", default=process_ml.EMBEDDING_MODEL)
+    parity_parser = commands.add_parser("parity", help="compare KNN labels with the torch backend")
+    parity_parser.add_argument("--backend", choices=BACKENDS, default=process_ml.EMBEDDING_BACKEND)
+    parity_parser.add_argument("--csv", default="dataset/synthetic_logs.csv")
+    bench_parser = commands.add_parser("bench", help="encode throughput and peak RSS per backend")
+    bench_parser.add_argument("--backends", default=",".join(BACKENDS))
+    bench_parser.add_argument("--csv", default="dataset/synthetic_logs.csv")
+    bench_parser.add_argument("--batch-size", type=int, default=64)
+    bench_parser.add_argument("--max-seq-length", type=int, default=process_ml.EMBEDDING_MAX_SEQ_LENGTH)
+    bench_parser.add_argument("--threads", type=int, default=1, help="intra-op threads, 0 for all cores")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.model, args.model_dir)
+        print(f"Wrote {', '.join(ONNX_FILES.values())} to {args.model_dir}")
+    elif args.command == "parity":
+        result = parity(args.backend, csv_path=args.csv)
+        print(f"{args.backend} vs torch on {result['messages']} messages: labels agree on "
+              f"{result['label_agreement']:.2%}, cosine min {result['min_cosine']} mean {result['mean_cosine']}")
+        for message, old, new in result["differing"]:
+            print(f"  {old} -> {new}: {message[:100]}")
+    else:
+        print(f"{'backend':>10} {'load s':>7} {'encodes/s':>10} {'per thread':>11} {'peak RSS MB':>12}")
+        for result in bench(args.backends.split(","), args.csv, args.batch_size, args.max_seq_length, args.threads):
+            if "error" in result:
+                print(f"{result['backend']:>10} {result['error']}")
+                continue
+            print(f"{result['backend']:>10} {result['load_seconds']:>7} {result['encodes_per_second']:>10,.1f} "
+                  f"{result['encodes_per_second_per_thread']:>11,.1f} {result['peak_rss_mb']:>12,.0f}")
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Variable tokens that are replaced by a placeholder, most specific first
+_TEMPLATE_RULES = [
+    (re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b", re.IGNORECASE), "<UUID>"),
+    (re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b"), "<IP>"),
+    (re.compile(r"\b(?=[0-9a-f]*\d)[0-9a-f]{8,}\b", re.IGNORECASE), "<HEX>"),
+    (re.compile(r"\d+(?:\.\d+)?"), "<NUM>"),
+]
+
+
+def log_template(log_msg):
+    """Normalize IDs, IPs, UUIDs and numbers so repeats of a message share one key."""
+    for pattern, placeholder in _TEMPLATE_RULES:
+        log_msg = pattern.sub(placeholder, log_msg)
+    return log_msg
+
+
+def file_fingerprint(path):
+    """Content hash of a model file, used to tell which model produced a label."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingCache:
+    """Template -> label cache in front of the ML tier (and, without embeddings, the LLM tier).
+
+    Labels live in a bounded in-process LRU. When a path is given, templates,
+    their float32 embeddings and labels are also kept in SQLite so they survive
+    restarts. Labels are only valid for the model_version that produced them;
+    embeddings outlive a model change, so a retrained classifier only has to
+    re-run the KNN, not the transformer.
+    """
+
+    def __init__(self, maxsize=100000, path=None, table="ml_cache"):
+        self.maxsize = maxsize
+        self.path = path
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._labels = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path:
+            with self._connect() as conn:
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {self.table} (
+                        template TEXT PRIMARY KEY,
+                        embedding BLOB,
+                        label TEXT,
+                        model_version TEXT
+                    )
+                ''')
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared across threads or forked processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get_labels(self, templates, model_version):
+        """Return {template: label} for every template with a valid cached label."""
+        found = {}
+        with self._lock:
+            for template in templates:
+                entry = self._labels.get(template)
+                if entry is not None and entry[1] == model_version:
+                    self._labels.move_to_end(template)
+                    found[template] = entry[0]
+
+        missing = [template for template in templates if template not in found]
+        if self.path and missing:
+            for template, label in self._select(missing, "label", model_version):
+                found[template] = label
+                self._remember(template, label, model_version)
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(templates) - len(found)
+        return found
+
+    def get_embeddings(self, templates):
+        """Return {template: embedding} for templates stored on disk, whatever the model version."""
+        if not self.path or not templates:
+            return {}
+        return {
+            template: np.frombuffer(blob, dtype=np.float32)
+            for template, blob in self._select(templates, "embedding")
+        }
+
+    def put(self, templates, labels, model_version, embeddings=None):
+        for template, label in zip(templates, labels):
+            self._remember(template, label, model_version)
+        if self.path:
+            if embeddings is None:
+                rows = [(template, None, label, model_version) for template, label in zip(templates, labels)]
+            else:
+                rows = [
+                    (template, np.asarray(embedding, dtype=np.float32).tobytes(), label, model_version)
+                    for template, embedding, label in zip(templates, embeddings, labels)
+                ]
+            conn = self._connect()
+            with conn:
+                conn.executemany(f'''
+                    INSERT INTO {self.table} (template, embedding, label, model_version) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(template) DO UPDATE SET
+                        embedding = COALESCE(excluded.embedding, {self.table}.embedding),
+                        label = excluded.label,
+                        model_version = excluded.model_version
+                ''', rows)
+
+    def clear(self):
+        with self._lock:
+            self._labels.clear()
+            self.hits = self.misses = 0
+        if self.path:
+            conn = self._connect()
+            with conn:
+                conn.execute(f'DELETE FROM {self.table}')
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'size': len(self._labels),
+            }
+
+    def _remember(self, template, label, model_version):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._labels[template] = (label, model_version)
+            self._labels.move_to_end(template)
+            while len(self._labels) > self.maxsize:
+                self._labels.popitem(last=False)
+
+    def _select(self, templates, column, model_version=None):
+        conn = self._connect()
+        rows = []
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(templates), 500):
+            chunk = templates[start:start + 500]
+            query = f'SELECT template, {column} FROM {self.table} WHERE {column} IS NOT NULL AND template IN ({",".join("?" * len(chunk))})'
+            params = list(chunk)
+            if model_version is not None:
+                query += ' AND model_version = ?'
+                params.append(model_version)
+            rows.extend(conn.execute(query, params).fetchall())
+        return rows
@@ -0,0 +1,256 @@
+"""Local inference daemon that owns the ML tier's models for every worker on the box.
+
+    python inference_server.py --socket /tmp/log_classifier_ml.sock
+    ML_SERVER_SOCKET=/tmp/log_classifier_ml.sock gunicorn app:application -w 8
+
+With ML_SERVER_SOCKET set, process_ml.classify_with_ml_batch sends its
+messages here instead of loading the SentenceTransformer and the KNN in each
+worker. Requests from all connections are coalesced into micro-batches of up
+to --max-batch messages, waiting at most --max-wait-ms for a batch to fill.
+At most --queue requests wait for the model; further senders block until
+there is room, which pushes back on the workers instead of growing memory.
+
+Frames are a 4-byte big-endian length followed by UTF-8 JSON:
+{"messages": [...]} -> {"labels": [...], "confidences": [...], "model_version": ..., "embedding_version": ...}
+or {"error": "..."}. The versions are the daemon's, for the rows' provenance stamps.
+"""
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+ML_SERVER_MAX_BATCH = int(os.getenv("ML_SERVER_MAX_BATCH", 256))  # messages per micro-batch
+ML_SERVER_MAX_WAIT_MS = float(os.getenv("ML_SERVER_MAX_WAIT_MS", 5))
+ML_SERVER_QUEUE = int(os.getenv("ML_SERVER_QUEUE", 64))  # requests waiting for the model
+ML_SERVER_TIMEOUT = float(os.getenv("ML_SERVER_TIMEOUT", 120))  # seconds a client waits for its answer
+
+_HEADER = struct.Struct(">I")
+
+
+def send_frame(sock, payload):
+    data = json.dumps(payload).encode()
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    """Read one frame; None when the peer closed the connection between frames."""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        raise ConnectionError("connection closed mid-frame")
+    return json.loads(data)
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        part = sock.recv(size - len(buffer))
+        if not part:
+            return None
+        buffer += part
+    return bytes(buffer)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    # One thread per connection; each request waits for the micro-batch it lands in
+    def handle(self):
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (ConnectionError, ValueError):
+                return
+            if request is None:
+                return
+            future = Future()
+            self.server.pending.put((list(request["messages"]), future))  # blocks while the queue is full
+            try:
+                labels, confidences, model_version, embedding_version = future.result()
+                response = {"labels": labels, "confidences": confidences, "model_version": model_version,
+                            "embedding_version": embedding_version}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            try:
+                send_frame(self.request, response)
+            except OSError:
+                return
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    """Unix-socket server feeding one batching thread that runs process_ml in this process."""
+
+    daemon_threads = True
+    # Connections not yet accepted; past it a Unix socket refuses at once (EAGAIN) instead of
+    # waiting, and socketserver's default of 5 is less than one gunicorn worker pool starting up
+    request_queue_size = 128
+
+    def __init__(self, path, max_batch=ML_SERVER_MAX_BATCH, max_wait_ms=ML_SERVER_MAX_WAIT_MS, queue_size=ML_SERVER_QUEUE,
+                 classify_batch=None):
+        import process_ml
+        # This process is where the models live, its own calls must not loop back here
+        process_ml.ML_SERVER_SOCKET = None
+        self.classify_batch = classify_batch or process_ml.classify_with_ml_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.batches = self.messages = 0
+        if os.path.exists(path):
+            os.unlink(path)  # left over from a daemon that did not shut down cleanly
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o660)
+        self._batcher = threading.Thread(target=self._run_batches, daemon=True)
+        self._batcher.start()
+
+    def _next_batch(self):
+        # The first request, then whatever else arrives before max_wait or max_batch
+        batch = [self.pending.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.pending.get(timeout=timeout) if timeout > 0 else self.pending.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run_batches(self):
+        import process_ml
+        while True:
+            batch = self._next_batch()
+            messages = [message for request, _ in batch for message in request]
+            try:
+                results = self.classify_batch(messages, return_confidence=True)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.messages += len(messages)
+            start = 0
+            for request, future in batch:
+                answers = results[start:start + len(request)]
+                start += len(request)
+                future.set_result(([label for label, _ in answers], [confidence for _, confidence in answers],
+                                   process_ml.model_version, process_ml.embedding_version()))
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class InferenceClient:
+    """Sends classify requests to an InferenceServer; one connection per thread and process."""
+
+    def __init__(self, path, timeout=ML_SERVER_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock, self._local.pid = sock, os.getpid()
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def classify(self, log_msgs):
+        """Return (labels, confidences, model_version, embedding_version) for log_msgs.
+
+        Raises ConnectionError if the daemon cannot be reached, after one
+        reconnect in case it restarted since the last request, or if it does
+        not answer within the timeout.
+        """
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_frame(sock, {"messages": list(log_msgs)})
+                response = recv_frame(sock)
+                if response is None:
+                    raise ConnectionError("inference server closed the connection")
+                break
+            except socket.timeout as e:
+                # A stuck daemon is treated like a missing one; retrying would wait as long again
+                self._close()
+                raise ConnectionError(f"inference server at {self.path} did not answer in {self.timeout:g}s") from e
+            except OSError as e:
+                self._close()
+                if attempt:
+                    raise ConnectionError(f"inference server at {self.path} unreachable: {e}") from e
+        if "error" in response:
+            raise RuntimeError(f"inference server: {response['error']}")
+        return response["labels"], response["confidences"], response["model_version"], response["embedding_version"]
+
+
+def _bench(path, clients=8, requests=200, messages_per_request=1):
+    # Many small concurrent requests, like workers classifying the regex misses of small uploads
+    from concurrent.futures import ThreadPoolExecutor
+    client = InferenceClient(path)
+    messages = [f"Server A{i} was restarted unexpectedly during the process of data transfer" for i in range(1000)]
+
+    def worker(offset):
+        for i in range(requests):
+            start = (offset * requests + i) * messages_per_request % len(messages)
+            client.classify(messages[start:start + messages_per_request])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(worker, range(clients)))
+    seconds = time.perf_counter() - started
+    total = clients * requests
+    print(f"{total} requests from {clients} clients in {seconds:.2f}s ({total / seconds:,.0f} requests/s)")
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(description="Serve the ML tier's models to local workers over a Unix socket.")
+    parser.add_argument("--socket", default=os.getenv("ML_SERVER_SOCKET") or "/tmp/log_classifier_ml.sock")
+    parser.add_argument("--max-batch", type=int, default=ML_SERVER_MAX_BATCH, help="messages per micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=ML_SERVER_MAX_WAIT_MS,
+                        help="how long a micro-batch waits to fill (default: %(default)s)")
+    parser.add_argument("--queue", type=int, default=ML_SERVER_QUEUE, help="requests waiting for the model")
+    parser.add_argument("--bench", type=int, metavar="CLIENTS",
+                        help="instead of serving, time this many concurrent clients against a running daemon")
+    args = parser.parse_args()
+
+    if args.bench:
+        _bench(args.socket, clients=args.bench)
+        raise SystemExit
+
+    server = InferenceServer(args.socket, args.max_batch, args.max_wait_ms, args.queue)
+    import process_ml
+    process_ml.load_models()
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Serving the ML tier on {args.socket} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.batches:
+            print(f"{server.messages} messages in {server.batches} batches "
+                  f"({server.messages / server.batches:.1f} per batch)")
@@ -0,0 +1,477 @@
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+import columnar
+import db
+import metrics
+import rollups
+
+# Uploads are classified by this pool instead of inside the request
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_EXECUTOR = os.getenv('JOB_EXECUTOR', 'thread')  # 'thread' or 'process'
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+# Where classified rows go: 'sqlite' (a table per upload) or 'columnar' (see columnar.py)
+RESULT_STORAGE = os.getenv('RESULT_STORAGE', 'sqlite')
+# Store a per-job breakdown of where the time went (see run_job) in jobs.timings
+JOB_TIMINGS = os.getenv('JOB_TIMINGS', '1') == '1'
+# A running job whose updated_at is older than this lost its worker (a crash or
+# redeploy) and is run again; progress updates after every chunk renew it
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 900))
+# Anonymous users' results (temp_<job id>) are dropped this long after their job ended
+TEMP_RESULTS_TTL_SECONDS = int(os.getenv('TEMP_RESULTS_TTL_SECONDS', 24 * 3600))
+TEMP_CLEANUP_INTERVAL_SECONDS = 3600
+
+_executor = None
+_next_cleanup = None
+
+
+def init_jobs_table(db_path):
+    conn = db.connect(db_path)
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                username TEXT,
+                file_name TEXT NOT NULL,
+                input_path TEXT NOT NULL,
+                output_path TEXT,
+                status TEXT NOT NULL DEFAULT 'queued',
+                rows_processed INTEGER NOT NULL DEFAULT 0,
+                table_name TEXT,
+                error TEXT,
+                timings TEXT,
+                unique_rows INTEGER,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        ''')
+        # Jobs tables created before these columns existed
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+        if 'timings' not in columns:
+            conn.execute('ALTER TABLE jobs ADD COLUMN timings TEXT')
+        if 'unique_rows' not in columns:
+            conn.execute('ALTER TABLE jobs ADD COLUMN unique_rows INTEGER')
+
+
+def _now():
+    return pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def create_job(db_path, username, filename, upload_dir='uploads', output_dir=None):
+    """Record a queued job; the caller saves the upload to job['input_path'] and submits it.
+
+    With output_dir set, the labelled rows are also written to a per-job CSV there.
+    """
+    job_id = uuid.uuid4().hex
+    # Per-job paths, so concurrent uploads of the same file name never clash
+    input_path = os.path.join(upload_dir, f'{job_id}_{filename}')
+    output_path = os.path.join(output_dir, f'output_{job_id}.csv') if output_dir else None
+    file_name = filename.rsplit('.', 1)[0]
+    conn = db.connect(db_path)
+    with conn:
+        conn.execute('''
+            INSERT INTO jobs (id, username, file_name, input_path, output_path, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)
+        ''', (job_id, username, file_name, input_path, output_path, _now(), _now()))
+    return get_job(db_path, job_id)
+
+
+def get_job(db_path, job_id):
+    rows = db.fetch_dicts(db.connect(db_path), 'SELECT * FROM jobs WHERE id = ?', (job_id,))
+    return rows[0] if rows else None
+
+
+def _update_job(db_path, job_id, **fields):
+    fields['updated_at'] = _now()
+    conn = db.connect(db_path)
+    with conn:
+        conn.execute(
+            f'UPDATE jobs SET {", ".join(f"{name} = ?" for name in fields)} WHERE id = ?',
+            (*fields.values(), job_id))
+
+
+def _claim_job(db_path, job_id):
+    # Only one worker may move a job from queued (or running with an expired lease) to running
+    conn = db.connect(db_path)
+    with conn:
+        cursor = conn.execute('''
+            UPDATE jobs SET status = 'running', updated_at = ?
+            WHERE id = ? AND (status = 'queued' OR status = 'running' AND updated_at < ?)
+        ''', (_now(), job_id, _lease_cutoff(JOB_LEASE_SECONDS)))
+    return cursor.rowcount == 1
+
+
+def _lease_cutoff(lease_seconds):
+    # updated_at values older than this are expired leases; same format as _now()
+    return (pd.Timestamp.now() - pd.Timedelta(seconds=lease_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def watch_lease(db_path, table, row_id, submit, lease_seconds):
+    """Call submit(db_path, row_id) once a running row of table (jobs, reclassify_runs) lets its lease expire.
+
+    Checks again whenever the lease would run out, for as long as the row stays running.
+    """
+    row = db.connect(db_path).execute(f'SELECT status, updated_at FROM {table} WHERE id = ?', (row_id,)).fetchone()
+    if row is None or row[0] != 'running':
+        return
+    seconds_left = lease_seconds - (pd.Timestamp.now() - pd.Timestamp(row[1])).total_seconds()
+    if seconds_left < 0:
+        submit(db_path, row_id)
+        return
+    timer = threading.Timer(seconds_left + 1, watch_lease, (db_path, table, row_id, submit, lease_seconds))
+    timer.daemon = True
+    timer.start()
+
+
+def generate_unique_table_name(conn, base_name):
+    """Generate a unique table name by appending a numeric postfix if needed."""
+    # One indexed range query fetches the base name and every base_name_N already
+    # used, whether registered in uploads or existing as any other table
+    prefix_start, prefix_end = f'{base_name}_', f'{base_name}`'  # '`' sorts right after '_'
+    # (SQLite table names are case-insensitive)
+    taken = {row[0].lower() for row in conn.execute('''
+        SELECT table_name FROM uploads
+        WHERE table_name = ?1 COLLATE NOCASE OR (table_name >= ?2 COLLATE NOCASE AND table_name < ?3 COLLATE NOCASE)
+        UNION
+        SELECT table_name FROM jobs
+        WHERE status IN ('queued', 'running')
+        AND (table_name = ?1 COLLATE NOCASE OR (table_name >= ?2 COLLATE NOCASE AND table_name < ?3 COLLATE NOCASE))
+        UNION
+        SELECT name FROM sqlite_master
+        WHERE name = ?1 COLLATE NOCASE OR (name >= ?2 COLLATE NOCASE AND name < ?3 COLLATE NOCASE)
+    ''', (base_name, prefix_start, prefix_end))}
+    postfix = 0
+    unique_name = base_name
+    while unique_name.lower() in taken or columnar.exists(unique_name):
+        postfix += 1
+        unique_name = f"{base_name}_{postfix}"
+    return unique_name
+
+
+def reserve_table_name(db_path, job_id, base_name):
+    """Pick a free result table name for a job and record it on the job in one transaction.
+
+    The write lock is taken before looking, so concurrent jobs for the same
+    file name (in any process) get different names.
+    """
+    conn = db.connect(db_path)
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        table_name = generate_unique_table_name(conn, base_name)
+        conn.execute('UPDATE jobs SET table_name = ?, updated_at = ? WHERE id = ?', (table_name, _now(), job_id))
+    return table_name
+
+
+# Which tier decided a row's label and the classify.tier_versions() stamp it had then
+PROVENANCE_COLUMNS = ('tier', 'label_version')
+
+
+def create_result_table(conn, table_name):
+    with conn:
+        # No IF NOT EXISTS: a name clash must fail, not mix two uploads in one table
+        conn.execute(f'''
+            CREATE TABLE {table_name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source TEXT,
+                log_message TEXT,
+                target_label TEXT,
+                tier TEXT,
+                label_version TEXT
+            )
+        ''')
+
+
+def add_provenance_columns(conn, table_name):
+    """Add the PROVENANCE_COLUMNS to a result table created before they existed."""
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')}
+    with conn:
+        for column in PROVENANCE_COLUMNS:
+            if column not in existing:
+                conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column} TEXT')
+
+
+def _csv_columns(chunk):
+    # The CSV output keeps the input's columns plus target_label only
+    return chunk.drop(columns=list(PROVENANCE_COLUMNS), errors='ignore')
+
+
+def summarize_table(conn, table_name):
+    """Index a result table by label and (re)write its label counts to upload_label_counts."""
+    table = columnar.open_table(table_name)
+    if table is not None:
+        write_label_counts(conn, table_name, table.summary())
+        return
+    with conn:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_label ON {table_name} (target_label, id)')
+        conn.execute('DELETE FROM upload_label_counts WHERE table_name = ?', (table_name,))
+        # first_id keeps labels in order of first appearance, like DataFrame.unique()
+        conn.execute(f'''
+            INSERT INTO upload_label_counts (table_name, target_label, count, first_id)
+            SELECT ?, target_label, COUNT(*), MIN(id)
+            FROM {table_name}
+            WHERE target_label IS NOT NULL
+            GROUP BY target_label
+        ''', (table_name,))
+
+
+def write_label_counts(conn, table_name, summary):
+    """Replace a table's rows in upload_label_counts with [(label, count, first_id)]."""
+    with conn:
+        conn.execute('DELETE FROM upload_label_counts WHERE table_name = ?', (table_name,))
+        conn.executemany(
+            'INSERT INTO upload_label_counts (table_name, target_label, count, first_id) VALUES (?, ?, ?, ?)',
+            [(table_name, *row) for row in summary])
+
+
+def get_label_counts(conn, table_name):
+    """Return {label: count} for a result table, summarizing it first if it predates the summaries."""
+    query = 'SELECT target_label, count FROM upload_label_counts WHERE table_name = ? ORDER BY first_id'
+    rows = conn.execute(query, (table_name,)).fetchall()
+    if not rows:
+        summarize_table(conn, table_name)
+        rows = conn.execute(query, (table_name,)).fetchall()
+    return dict(rows)
+
+
+def store_chunks(conn, table_name, chunks, output_path=None, timings=None):
+    """Append labelled chunks to a result table (and optionally a CSV) as they arrive.
+
+    If timings is a dict, the seconds spent on each kind of write are added to it.
+    """
+    clock = time.perf_counter
+    spent = {'sqlite_insert_seconds': 0.0, 'csv_write_seconds': 0.0}
+    create_result_table(conn, table_name)
+    for i, chunk in enumerate(chunks):
+        started = clock()
+        # One executemany per chunk in its own transaction: bulk speed, while
+        # progress updates between chunks can still commit
+        columns = ['source', 'log_message', 'target_label'] + [c for c in PROVENANCE_COLUMNS if c in chunk]
+        insert = f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        rows = chunk[columns]
+        rows = rows.astype(object).where(rows.notna(), None)
+        with conn:
+            conn.executemany(insert, rows.itertuples(index=False, name=None))
+        inserted = clock()
+        metrics.SQLITE_WRITE_SECONDS.observe(inserted - started, operation='insert')
+        spent['sqlite_insert_seconds'] += inserted - started
+        if output_path:
+            _csv_columns(chunk).to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            spent['csv_write_seconds'] += clock() - inserted
+    started = clock()
+    summarize_table(conn, table_name)
+    spent['sqlite_summarize_seconds'] = clock() - started
+    metrics.SQLITE_WRITE_SECONDS.observe(spent['sqlite_summarize_seconds'], operation='summarize')
+    if timings is not None:
+        for name, seconds in spent.items():
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def store_columnar(conn, table_name, chunks, output_path=None, timings=None):
+    """Like store_chunks, but the rows go to a columnar table (see columnar.py) instead of SQLite."""
+    clock = time.perf_counter
+    spent = {'csv_write_seconds': 0.0}
+    upstream = [0.0]  # time write_table spent waiting for chunks, i.e. classifying
+
+    def timed_chunks():
+        iterator = iter(chunks)
+        for i in itertools.count():
+            started = clock()
+            chunk = next(iterator, None)
+            upstream[0] += clock() - started
+            if chunk is None:
+                return
+            if output_path:
+                started = clock()
+                _csv_columns(chunk).to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+                spent['csv_write_seconds'] += clock() - started
+            yield chunk
+
+    started = clock()
+    summary = columnar.write_table(table_name, timed_chunks())
+    spent['columnar_write_seconds'] = clock() - started - upstream[0] - spent['csv_write_seconds']
+    started = clock()
+    write_label_counts(conn, table_name, summary)
+    spent['sqlite_summarize_seconds'] = clock() - started
+    metrics.SQLITE_WRITE_SECONDS.observe(spent['sqlite_summarize_seconds'], operation='summarize')
+    if timings is not None:
+        for name, seconds in spent.items():
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def drop_result_table(conn, table_name):
+    """Remove a result table and its label summary, whichever storage holds it."""
+    columnar.drop_table(table_name)
+    with conn:
+        conn.execute(f'DROP TABLE IF EXISTS {table_name}')
+        conn.execute('DELETE FROM upload_label_counts WHERE table_name = ?', (table_name,))
+
+
+def register_upload(conn, username, file_name, table_name, label_counts=None):
+    """Record a user's upload, with its rollups if label_counts (see rollups.count_chunk) is given."""
+    upload_date = _now()
+    with conn:
+        conn.execute('''
+            INSERT INTO uploads (username, file_name, upload_date, table_name, rollups_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (username, file_name, upload_date, table_name, upload_date if label_counts is not None else None))
+        if label_counts is not None:
+            rollups.add_upload(conn, username, table_name, upload_date, label_counts)
+
+
+def delete_upload(conn, username, table_name):
+    """Remove one of a user's uploads with its results and rollups; False if they have no such upload."""
+    with conn:
+        cursor = conn.execute('DELETE FROM uploads WHERE table_name = ? AND username = ?', (table_name, username))
+        if cursor.rowcount == 0:
+            return False
+        rollups.delete_upload(conn, table_name)
+        # A run still working on the table stops at its next batch and removes what it wrote
+        conn.execute('''
+            UPDATE reclassify_runs SET status = 'cancelled', updated_at = ?
+            WHERE table_name = ? AND status IN ('queued', 'running')
+        ''', (_now(), table_name))
+    drop_result_table(conn, table_name)
+    return True
+
+
+def _timings_json(timings, total_seconds):
+    # Classification (reading the CSV included) is whatever the writes did not take
+    writes = sum(seconds for name, seconds in timings.items() if name.endswith('_seconds'))
+    rows = timings.get('rows', 0)
+    breakdown = dict(timings, rows=rows, total_seconds=total_seconds,
+                     classify_seconds=max(total_seconds - writes, 0.0),
+                     rows_per_second=rows / total_seconds if total_seconds else 0.0)
+    return json.dumps({name: round(value, 4) if isinstance(value, float) else value
+                       for name, value in breakdown.items()})
+
+
+def _counting(chunks, label_counts):
+    # Rollup counts are taken as the chunks stream past, the result table is never re-read
+    for chunk in chunks:
+        rollups.count_chunk(label_counts, chunk)
+        yield chunk
+
+
+def run_job(db_path, job_id):
+    """Classify a queued upload; runs in a worker thread or process.
+
+    Labelled chunks go straight into the job's result table: a registered
+    upload table for logged-in users, a temp_<job id> table otherwise.
+    """
+    from classify import classify_csv_chunks
+
+    if not _claim_job(db_path, job_id):
+        return
+    job = get_job(db_path, job_id)
+    conn = db.connect(db_path)
+    if job['table_name']:
+        # Left by an attempt whose worker died; it finished if the upload got registered
+        if conn.execute('SELECT 1 FROM uploads WHERE table_name = ?', (job['table_name'],)).fetchone():
+            _update_job(db_path, job_id, status='done')
+            return
+        drop_result_table(conn, job['table_name'])
+    table_name = None
+    started = time.perf_counter()
+    timings = {}
+    dedup = {}  # rows and distinct (source, message) pairs per chunk, see classify_csv_chunks
+    try:
+        def report_progress(rows_done, rows_per_second):
+            timings['rows'] = rows_done
+            _update_job(db_path, job_id, rows_processed=rows_done)
+
+        # The job records its table, so a retry can clean it up
+        if job['username']:
+            table_name = reserve_table_name(db_path, job_id, job['file_name'])
+        else:
+            table_name = f'temp_{job_id}'
+            _update_job(db_path, job_id, table_name=table_name)
+        chunks = classify_csv_chunks(job['input_path'], progress=report_progress, provenance=True, stats=dedup)
+        label_counts = Counter()
+        if job['username']:
+            chunks = _counting(chunks, label_counts)
+        store = store_columnar if RESULT_STORAGE == 'columnar' else store_chunks
+        store(conn, table_name, chunks, job['output_path'], timings)
+        if job['username']:
+            register_upload(conn, job['username'], job['file_name'], table_name, label_counts)
+        _update_job(db_path, job_id, status='done', table_name=table_name, unique_rows=dedup.get('unique_rows'),
+                    **({'timings': _timings_json(timings, time.perf_counter() - started)} if JOB_TIMINGS else {}))
+    except Exception as e:
+        if table_name:
+            # Leave no half-filled result table behind
+            drop_result_table(conn, table_name)
+        _update_job(db_path, job_id, status='failed', error=str(e))
+    _maybe_clear_expired_results(db_path)
+
+
+def clear_expired_results(db_path):
+    """Drop the temp_<job id> results of jobs that ended more than TEMP_RESULTS_TTL_SECONDS ago.
+
+    Also removes columnar .tmp- directories that old, left by interrupted writes.
+    Tables of running jobs and of recently finished ones are never touched.
+    """
+    conn = db.connect(db_path)
+    cutoff = _lease_cutoff(TEMP_RESULTS_TTL_SECONDS)
+    expired = conn.execute('''
+        SELECT id, table_name FROM jobs
+        WHERE username IS NULL AND table_name IS NOT NULL AND status IN ('done', 'failed') AND updated_at < ?
+    ''', (cutoff,)).fetchall()
+    for job_id, table_name in expired:
+        drop_result_table(conn, table_name)
+        with conn:
+            conn.execute('UPDATE jobs SET table_name = NULL WHERE id = ?', (job_id,))
+    if os.path.isdir(columnar.RESULTS_DIR):
+        for name in os.listdir(columnar.RESULTS_DIR):
+            path = os.path.join(columnar.RESULTS_DIR, name)
+            if '.tmp-' in name and time.time() - os.path.getmtime(path) > TEMP_RESULTS_TTL_SECONDS:
+                columnar.drop_table(name)
+
+
+def _maybe_clear_expired_results(db_path):
+    # At most once per TEMP_CLEANUP_INTERVAL_SECONDS per process, from the job pool
+    global _next_cleanup
+    now = time.monotonic()
+    if _next_cleanup is not None and now < _next_cleanup:
+        return
+    _next_cleanup = now + TEMP_CLEANUP_INTERVAL_SECONDS
+    try:
+        clear_expired_results(db_path)
+    except Exception as e:
+        print(f"Clearing expired results failed: {e}")
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if JOB_EXECUTOR == 'process':
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='classify-job')
+    return _executor
+
+
+def submit_job(db_path, job_id):
+    _get_executor().submit(run_job, db_path, job_id)
+
+
+def resume_queued_jobs(db_path):
+    """Resubmit jobs left queued by a previous server process, and running ones once their lease expires.
+
+    A running job within its lease may belong to another live worker process,
+    so it is only taken over if that worker stops renewing it.
+    """
+    conn = db.connect(db_path)
+    for job_id, status in conn.execute(
+            "SELECT id, status FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall():
+        if status == 'queued':
+            submit_job(db_path, job_id)
+        else:
+            watch_lease(db_path, 'jobs', job_id, submit_job, JOB_LEASE_SECONDS)
@@ -0,0 +1,155 @@
+import json
+import os
+
+import numpy as np
+
+from embedding_cache import file_fingerprint
+
+
+class VectorKNN:
+    """Exact k-nearest-neighbour classifier over a contiguous float32 matrix.
+
+    A drop-in replacement for the scikit-learn KNeighborsClassifier in
+    models/: neighbours come from one matrix product per batch of queries
+    instead of a tree or brute-force search per row, and predict_proba
+    follows scikit-learn's uniform/distance weighting. MiniLM embeddings are
+    unit length, so for them the ranking is the same as by cosine similarity.
+    """
+
+    def __init__(self, vectors, labels, classes, n_neighbors=5, weights="uniform"):
+        self.vectors = vectors  # (n_samples, dim) float32, may be memory-mapped
+        self.labels = labels    # (n_samples,) index into classes
+        self.classes_ = np.asarray(classes)
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self._squared_norms = np.einsum("ij,ij->i", vectors, vectors)
+
+    @classmethod
+    def from_classifier(cls, classifier):
+        params = classifier.get_params()
+        if params["metric"] not in ("euclidean", "minkowski") or (params["metric"] == "minkowski" and params["p"] != 2):
+            raise ValueError(f"VectorKNN only supports euclidean distance, not {classifier.effective_metric_}")
+        if params["weights"] not in ("uniform", "distance"):
+            raise ValueError("VectorKNN only supports 'uniform' and 'distance' weights")
+        return cls(
+            np.ascontiguousarray(classifier._fit_X, dtype=np.float32),
+            np.asarray(classifier._y, dtype=np.int64),
+            classifier.classes_,
+            n_neighbors=params["n_neighbors"],
+            weights=params["weights"],
+        )
+
+    def save(self, index_dir, fingerprint=None):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "vectors.npy"), self.vectors)
+        np.save(os.path.join(index_dir, "labels.npy"), self.labels)
+        with open(os.path.join(index_dir, "meta.json"), "w") as f:
+            json.dump({
+                "classes": self.classes_.tolist(),
+                "n_neighbors": self.n_neighbors,
+                "weights": self.weights,
+                "fingerprint": fingerprint,
+            }, f)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        index = cls(
+            np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(index_dir, "labels.npy")),
+            meta["classes"],
+            n_neighbors=meta["n_neighbors"],
+            weights=meta["weights"],
+        )
+        index.fingerprint = meta["fingerprint"]
+        return index
+
+    @classmethod
+    def from_joblib(cls, classifier_path, index_dir):
+        """Load the index built from classifier_path, rebuilding it when the joblib file changed."""
+        fingerprint = file_fingerprint(classifier_path)
+        if os.path.exists(os.path.join(index_dir, "meta.json")):
+            index = cls.load(index_dir)
+            if index.fingerprint == fingerprint:
+                return index
+        from joblib import load
+        index = cls.from_classifier(load(classifier_path))
+        index.save(index_dir, fingerprint)
+        return cls.load(index_dir)
+
+    def kneighbors(self, queries, batch_size=1024):
+        """Return (distances, indices) of the n_neighbors nearest training vectors, nearest first."""
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(self.n_neighbors, len(self.vectors))
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), batch_size):
+            chunk = queries[start:start + batch_size]
+            # ||q - v||^2 = ||q||^2 + ||v||^2 - 2 q.v, one BLAS call for the whole chunk
+            squared = self._squared_norms[None, :] - 2 * (chunk @ self.vectors.T)
+            squared += np.einsum("ij,ij->i", chunk, chunk)[:, None]
+            nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            # The expansion cancels badly for near-identical vectors, so the k
+            # candidates' distances are taken directly: exact matches come out as 0
+            nearest_distances = np.linalg.norm(chunk[:, None, :] - self.vectors[nearest], axis=2)
+            order = np.argsort(nearest_distances, axis=1, kind="stable")
+            indices[start:start + len(chunk)] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:start + len(chunk)] = np.take_along_axis(nearest_distances, order, axis=1)
+        return distances, indices
+
+    def predict_proba(self, queries):
+        distances, indices = self.kneighbors(queries)
+        if self.weights == "distance":
+            # Like scikit-learn: exact matches take all the weight
+            with np.errstate(divide="ignore"):
+                weights = 1.0 / distances
+            exact = np.isinf(weights)
+            weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+        else:
+            weights = np.ones_like(distances)
+        probabilities = np.zeros((len(distances), len(self.classes_)))
+        np.add.at(probabilities, (np.arange(len(distances))[:, None], self.labels[indices]), weights)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, queries):
+        return self.classes_[self.predict_proba(queries).argmax(axis=1)]
+
+
+def _parity_and_benchmark(classifier_path="models/log_classification_model_knn.joblib", queries=256):
+    import time
+    from joblib import load
+
+    classifier = load(classifier_path)
+    index = VectorKNN.from_classifier(classifier)
+    rng = np.random.default_rng(0)
+
+    # Training vectors with noise stand in for fresh embeddings, no transformer needed
+    base = classifier._fit_X[rng.integers(0, len(classifier._fit_X), queries)]
+    sample = base + rng.normal(scale=0.05, size=base.shape).astype(np.float32)
+    sample /= np.linalg.norm(sample, axis=1, keepdims=True)
+    expected, got = classifier.predict_proba(sample), index.predict_proba(sample)
+    confident = expected.max(axis=1) >= 0.5
+    labels_match = np.array_equal(
+        np.where(confident, classifier.classes_[expected.argmax(axis=1)], "Unknown"),
+        np.where(got.max(axis=1) >= 0.5, index.classes_[got.argmax(axis=1)], "Unknown"))
+    print(f"Parity on {queries} queries: max |p diff| = {np.abs(expected - got).max():.2e}, labels match: {labels_match}")
+
+    print(f"{'training rows':>14} {'sklearn ms':>11} {'vector ms':>10}")
+    for factor in (1, 4, 16, 64):
+        fit_X = np.vstack([classifier._fit_X] * factor)
+        fit_X += rng.normal(scale=0.01, size=fit_X.shape).astype(np.float32) * (factor > 1)
+        y = np.tile(classifier._y, factor)
+        grown = type(classifier)(**classifier.get_params()).fit(fit_X, classifier.classes_[y])
+        grown_index = VectorKNN.from_classifier(grown)
+        timings = []
+        for model in (grown, grown_index):
+            started = time.perf_counter()
+            model.predict_proba(sample)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{len(fit_X):>14} {timings[0]:>11.1f} {timings[1]:>10.1f}")
+
+
+if __name__ == "__main__":
+    _parity_and_benchmark()
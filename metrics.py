@@ -0,0 +1,136 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached lookup to a slow LLM request
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_collectors = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key + (("le", "+Inf" if bound == float("inf") else repr(bound)),), cumulative))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+
+def register_collector(collect):
+    """Register a callable returning [(name, kind, documentation, [(labels dict, value)])], read at scrape time."""
+    _collectors.append(collect)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key)} {value}")
+    for collect in _collectors:
+        for name, kind, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(_label_key(labels))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics recorded by the classification pipeline, the job queue and the app.
+# Each process keeps its own; classify_csv's worker processes report their
+# tier counts and timings back to the parent
+TIER_SECONDS = Histogram('log_classifier_tier_seconds', 'Time a classify() batch spent in each tier.')
+ROWS = Counter('log_classifier_rows_total', 'Rows passed to classify().')
+DUPLICATE_ROWS = Counter('log_classifier_duplicate_rows_total', 'Rows classify() answered from an identical (source, message) pair in the same batch.')
+ML_UNKNOWN = Counter('log_classifier_ml_unknown_total', 'ML predictions reported as Unknown because they fell below the confidence threshold.')
+LLM_REQUEST_SECONDS = Histogram('log_classifier_llm_request_seconds', 'Latency of LLM requests, retries included.')
+LLM_PROMPT_BATCH_SIZE = Gauge('log_classifier_llm_prompt_batch_size', 'Most messages one LLM request carries (LLM_PROMPT_BATCH_SIZE).')
+LLM_MESSAGES_PER_REQUEST = Histogram('log_classifier_llm_messages_per_request', 'Log messages sent in each LLM request.',
+                                     buckets=(1, 2, 5, 10, 20, 50, 100))
+LLM_REQUEST_FAILURES = Counter('log_classifier_llm_request_failures_total', 'LLM requests that failed after every retry.')
+ML_SERVER_FALLBACKS = Counter('log_classifier_ml_server_fallbacks_total',
+                              'ML requests classified in process because the inference server was unreachable or timed out.')
+MODEL_LOAD_SECONDS = Gauge('log_classifier_model_load_seconds', 'Time the last load of each model took.')
+CSV_ROWS = Counter('log_classifier_csv_rows_total', 'Rows classified by classify_csv.')
+CSV_ROWS_PER_SECOND = Gauge('log_classifier_csv_rows_per_second', 'Throughput of the last finished classify_csv run.')
+SQLITE_WRITE_SECONDS = Histogram('log_classifier_sqlite_write_seconds', 'Time spent writing classification results to SQLite.')
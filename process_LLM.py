@@ -1,6 +1,13 @@
+import hashlib
+import json
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from google import genai
+from embedding_cache import EmbeddingCache, log_template
+import metrics
 
 load_dotenv()  # Loads the environment variables from .env file which includes G_API_KEY for the Gemini model
 
@@ -12,22 +19,277 @@ load_dotenv()  # Loads the environment variables from .env file which includes G
 #else:
 #    print("API key found with length:", len(api_key))
 
-client = genai.Client(api_key=os.getenv("G_API_KEY"))  # Initialize the Gemini API client with the API key
+client = None  # Gemini API client, created on first use by get_client()
+_client_lock = threading.Lock()
+# 'fake' answers offline from FakeClient (benchmarks, demos) after LLM_FAKE_LATENCY seconds
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+LLM_FAKE_LATENCY = float(os.getenv("LLM_FAKE_LATENCY", 0))
 
 
-def classify_with_llm(log_message):
-    prompt = f"""You are a log message classifier machine answers in one Word and one Word only. Your task is to analyze the following log message and classify it into one of these categories: ('Workflow Error', 'Deprications',  or "Unknown").  
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                if LLM_BACKEND == "fake":
+                    client = FakeClient(latency=LLM_FAKE_LATENCY)
+                else:
+                    from google import genai
+                    client = genai.Client(api_key=os.getenv("G_API_KEY"))  # Initialize the Gemini API client with the API key
+    return client
+
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.0-flash")  # The Gemini model to use for generating completions
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))  # Requests in flight at once
+LLM_RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", 10))  # Sustained request rate, bursts up to LLM_CONCURRENCY
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF_SECONDS = float(os.getenv("LLM_BACKOFF_SECONDS", 1))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 30))  # Per request
+
+LLM_PROMPT_BATCH_SIZE = int(os.getenv("LLM_PROMPT_BATCH_SIZE", 20))  # Messages per request, 1 sends one prompt per message
+
+# Every answer is checked against this set; anything else becomes "Unknown"
+ALLOWED_LABELS = ('Workflow Error', 'Deprecation', 'Unknown')
+
+PROMPT = """You are a log message classifier machine answers in one Word and one Word only. Your task is to analyze the following log message and classify it into one of these categories: ('Workflow Error', 'Deprecation',  or "Unknown").  
             The log message is: {log_message} .  
             Again Respond with ONLY One Word NO preambles or explanations."""
-  
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",  # The Gemini model to use for generating completions
-        contents=prompt
+
+BATCH_PROMPT = """You are a log message classifier. Classify each of the following numbered log messages into one of these categories: ('Workflow Error', 'Deprecation', or "Unknown").
+            Log messages:
+{numbered_messages}
+            Respond with ONLY a JSON array of {count} strings, the category of each message in the same order. NO preambles or explanations."""
+
+# Cached answers are tied to the model and the prompts that produced them
+PROMPT_VERSION = f"{LLM_MODEL}:{hashlib.sha1((PROMPT + BATCH_PROMPT).encode()).hexdigest()[:8]}"
+llm_cache = EmbeddingCache(
+    maxsize=int(os.getenv("LLM_CACHE_SIZE", 100000)),
+    path=os.getenv("LLM_CACHE_PATH") or None,
+    table="llm_cache",
+)
+
+
+class TokenBucket:
+    """Blocking token-bucket rate limiter shared by all LLM worker threads."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+rate_limiter = TokenBucket(LLM_RATE_PER_SEC, max(1, LLM_CONCURRENCY))
+
+
+def _generate(prompt, llm_client):
+    # Retries with exponential backoff and jitter; None once every attempt failed
+    with metrics.LLM_REQUEST_SECONDS.time():
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            rate_limiter.acquire()
+            try:
+                response = llm_client.models.generate_content(
+                    model=LLM_MODEL,
+                    contents=prompt,
+                    config={"http_options": {"timeout": int(LLM_TIMEOUT_SECONDS * 1000)}},
+                )
+                return response.text.strip()  # Return the response text stripped of any extra whitespace
+            except Exception:
+                if attempt == LLM_MAX_RETRIES:
+                    metrics.LLM_REQUEST_FAILURES.inc()
+                    _count(failed_requests=1)
+                    return None
+                time.sleep(LLM_BACKOFF_SECONDS * 2 ** attempt * (1 + random.random()))
+
+
+# Request counters, see llm_stats()
+_stats = {
+    'requests': 0,
+    'batched_requests': 0,
+    'messages': 0,
+    'invalid_replies': 0,
+    'individual_retries': 0,
+    'failed_requests': 0,
+    'failed_messages': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(**increments):
+    with _stats_lock:
+        for name, value in increments.items():
+            _stats[name] += value
+
+
+def llm_stats():
+    with _stats_lock:
+        stats = dict(_stats, prompt_batch_size=LLM_PROMPT_BATCH_SIZE)
+    stats['cache'] = llm_cache.stats()
+    return stats
+
+
+metrics.LLM_PROMPT_BATCH_SIZE.set(max(1, LLM_PROMPT_BATCH_SIZE))
+
+
+def _validate_label(answer):
+    if not isinstance(answer, str):
+        return None
+    answer = answer.strip().strip("'\".").lower()
+    for label in ALLOWED_LABELS:
+        if answer == label.lower():
+            return label
+    return None
+
+
+def _parse_batch_reply(text, count):
+    # The reply should be a JSON array; code fences or chatter around it are ignored
+    start, end = text.find("["), text.rfind("]")
+    try:
+        answers = json.loads(text[start:end + 1]) if start != -1 else None
+    except ValueError:
+        answers = None
+    if not isinstance(answers, list):
+        return [None] * count
+    answers = answers[:count] + [None] * (count - len(answers))
+    return [_validate_label(answer) for answer in answers]
+
+
+# _classify_single and _classify_group answer None for messages whose request
+# failed after every retry: they are reported as "Unknown" but not cached
+def _classify_single(log_message, llm_client):
+    _count(requests=1, messages=1)
+    metrics.LLM_MESSAGES_PER_REQUEST.observe(1)
+    reply = _generate(PROMPT.format(log_message=log_message), llm_client)
+    if reply is None:
+        _count(failed_messages=1)
+        return None
+    label = _validate_label(reply)
+    if label is None:
+        _count(invalid_replies=1)
+        label = "Unknown"
+    return label
+
+
+def _classify_group(log_messages, llm_client):
+    if len(log_messages) == 1:
+        return [_classify_single(log_messages[0], llm_client)]
+
+    numbered_messages = "\n".join(
+        f"{i}. {' '.join(log_message.split())}" for i, log_message in enumerate(log_messages, 1)
     )
-    return response.text.strip()  # Return the response text stripped of any extra whitespace
+    reply = _generate(BATCH_PROMPT.format(numbered_messages=numbered_messages, count=len(log_messages)), llm_client)
+    _count(requests=1, batched_requests=1, messages=len(log_messages))
+    metrics.LLM_MESSAGES_PER_REQUEST.observe(len(log_messages))
+    if reply is None:
+        # Asking each message again would only multiply the requests to a failing API
+        _count(failed_messages=len(log_messages))
+        return [None] * len(log_messages)
+    labels = _parse_batch_reply(reply, len(log_messages))
+
+    # Items with a bad or missing answer are asked again on their own
+    failed = [i for i, label in enumerate(labels) if label is None]
+    _count(invalid_replies=len(failed), individual_retries=len(failed))
+    for i in failed:
+        labels[i] = _classify_single(log_messages[i], llm_client)
+    return labels
+
+
+def classify_with_llm_batch(log_messages, llm_client=None, max_workers=LLM_CONCURRENCY,
+                            prompt_batch_size=LLM_PROMPT_BATCH_SIZE):
+    """Classify many log messages with bounded concurrency.
+
+    Template-equivalent messages are sent once and answers are cached, so
+    repeats within and across batches never reach the API. Up to
+    prompt_batch_size messages share one request. Messages whose request
+    failed after every retry are "Unknown" and asked again next time.
+    """
+    llm_client = llm_client or get_client()
+    keys = [log_template(log_message) for log_message in log_messages]
+    labels = llm_cache.get_labels(list(dict.fromkeys(keys)), PROMPT_VERSION)
+
+    pending = {}
+    for key, log_message in zip(keys, log_messages):
+        if key not in labels:
+            pending.setdefault(key, log_message)
+
+    if pending:
+        messages = list(pending.values())
+        step = max(1, prompt_batch_size)
+        metrics.LLM_PROMPT_BATCH_SIZE.set(step)
+        groups = [messages[start:start + step] for start in range(0, len(messages), step)]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            answers = [label for group in executor.map(lambda group: _classify_group(group, llm_client), groups)
+                       for label in group]
+        answered = [(key, answer) for key, answer in zip(pending, answers) if answer is not None]
+        llm_cache.put([key for key, _ in answered], [answer for _, answer in answered], PROMPT_VERSION)
+        labels.update(zip(pending, (answer or "Unknown" for answer in answers)))
+
+    return [labels[key] for key in keys]
+
+
+def classify_with_llm(log_message, llm_client=None):
+    return classify_with_llm_batch([log_message], llm_client)[0]
+
+
+class FakeClient:
+    """Offline stand-in for genai.Client, answering from keywords after an optional delay.
+
+    Understands both the single and the batched prompt; malformed_rate drops
+    answers from batched replies to exercise the per-item retry.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, malformed_rate=0.0):
+        self.models = self
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def answer(log_message):
+        text = log_message.lower()
+        if "deprecat" in text or "retired" in text or "discontinued" in text or "removed" in text:
+            return "Deprecation"
+        if "fail" in text or "error" in text or "halted" in text:
+            return "Workflow Error"
+        return "Unknown"
+
+    def generate_content(self, model, contents, config=None):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise ConnectionError("fake LLM request failed")
+        text = "Unknown"
+        if "Log messages:" in contents:
+            lines = contents.split("Log messages:")[1].split("Respond with")[0].strip().splitlines()
+            answers = [self.answer(line.split(". ", 1)[-1]) for line in lines]
+            answers = [answer if random.random() >= self.malformed_rate else "???" for answer in answers]
+            text = json.dumps(answers)
+        else:
+            text = self.answer(contents.split("The log message is:")[-1])
+        return type("FakeResponse", (), {"text": text})()
 
 
 if __name__ == "__main__":
+    import sys
+
     test_logs = [
         "Failed to execute workflow step 3: Invalid input parameters",
         "Warning: Function xyz() will be deprecated in version 2.0",
@@ -41,10 +303,12 @@ if __name__ == "__main__":
         "I love Burger"
     ]
 
+    # python process_LLM.py --fake runs offline against FakeClient
+    llm_client = FakeClient(latency=0.2) if "--fake" in sys.argv else get_client()
+
     print("\nTesting log message classification:")
     print("-" * 50)
-    for log in test_logs:
-        result = classify_with_llm(log)
+    for log, result in zip(test_logs, classify_with_llm_batch(test_logs, llm_client)):
         print(f"\nLog message: {log}")
         print(f"Classification: {result}")
-
+    print("\nStats:", llm_stats())
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from embedding_cache import file_fingerprint, log_template
+
+# Labelled logs the lookup tier is seeded from
+LOOKUP_SEED_PATH = os.getenv("LOOKUP_SEED_PATH", "dataset/synthetic_logs.csv")
+LOOKUP_MAX_SIZE = int(os.getenv("LOOKUP_MAX_SIZE", 200000))  # 0 turns the tier off
+LOOKUP_REFRESH_SECONDS = float(os.getenv("LOOKUP_REFRESH_SECONDS", 300))
+# ML answers at least this probable are remembered as templates
+LOOKUP_MIN_CONFIDENCE = float(os.getenv("LOOKUP_MIN_CONFIDENCE", 0.8))
+
+_lock = threading.Lock()
+_exact = {}                 # message -> label, from the seed file
+_templates = {}             # template -> label, from the seed file
+_learned = OrderedDict()    # template -> label, remembered ML answers, oldest evicted first
+_learned_version = None     # the rules and model version the learned answers came from
+_seed_mtime = None
+_seed_version = None
+_last_refresh = 0.0
+
+
+def _load_seed():
+    # Only messages and templates whose labels all agree are kept
+    import pandas as pd
+    df = pd.read_csv(LOOKUP_SEED_PATH, usecols=["source", "log_message", "target_label"])
+    df = df[(df["source"] != "LegacyCRM") & df["log_message"].notna() & df["target_label"].notna()]
+    df = df.assign(template=df["log_message"].map(log_template))
+
+    def unambiguous(column):
+        labels = df.groupby(column)["target_label"]
+        consistent = labels.nunique() == 1
+        return labels.first()[consistent].to_dict()
+
+    return unambiguous("log_message"), unambiguous("template")
+
+
+def refresh(force=False):
+    """Reload the seed file if it changed since the last load."""
+    global _exact, _templates, _seed_mtime, _seed_version, _last_refresh
+    _last_refresh = time.monotonic()
+    if LOOKUP_MAX_SIZE <= 0 or not os.path.exists(LOOKUP_SEED_PATH):
+        return
+    mtime = os.stat(LOOKUP_SEED_PATH).st_mtime_ns
+    if not force and mtime == _seed_mtime:
+        return
+    exact, templates = _load_seed()
+    version = file_fingerprint(LOOKUP_SEED_PATH)
+    with _lock:
+        _exact = dict(list(exact.items())[:LOOKUP_MAX_SIZE])
+        _templates = dict(list(templates.items())[:LOOKUP_MAX_SIZE])
+        _seed_mtime = mtime
+        _seed_version = version
+
+
+def seed_version():
+    """Fingerprint of the seed file the index was loaded from, "off" when the tier is off."""
+    if LOOKUP_MAX_SIZE <= 0 or not os.path.exists(LOOKUP_SEED_PATH):
+        return "off"
+    if _seed_version is None:
+        refresh()
+    return _seed_version
+
+
+def classify_with_lookup(log_msg, with_origin=False, learned_version=None):
+    """Label from the exact-message or template index, or None.
+
+    Remembered ML answers are only used when learned_version is the version
+    they were remembered under, so a new model or rule set is asked again.
+    with_origin returns (label, origin) instead, origin being "seed" or
+    "learned" (a remembered ML answer), or None on a miss.
+    """
+    if LOOKUP_MAX_SIZE <= 0:
+        return (None, None) if with_origin else None
+    # The first call loads the seed whatever the monotonic clock reads (it can be below the interval after boot)
+    if _seed_mtime is None or time.monotonic() - _last_refresh > LOOKUP_REFRESH_SECONDS:
+        refresh()
+    origin = "seed"
+    label = _exact.get(log_msg)
+    if label is None:
+        template = log_template(log_msg)
+        label = _templates.get(template)
+        if label is None and learned_version is not None and learned_version == _learned_version:
+            label = _learned.get(template)
+            origin = "learned"
+    if with_origin:
+        return label, origin if label is not None else None
+    return label
+
+
+def remember(log_msgs, labels, version=None):
+    """Add confidently classified messages to the template index.
+
+    version identifies the rules and model behind the labels; remembering
+    under a new version forgets everything learned under the old one.
+    """
+    global _learned_version
+    if LOOKUP_MAX_SIZE <= 0:
+        return
+    with _lock:
+        if version != _learned_version:
+            _learned.clear()
+            _learned_version = version
+        for log_msg, label in zip(log_msgs, labels):
+            if label != "Unknown":
+                template = log_template(log_msg)
+                if template not in _templates:
+                    _learned[template] = label
+                    _learned.move_to_end(template)
+        while len(_learned) > LOOKUP_MAX_SIZE:
+            _learned.popitem(last=False)
+
+
+def lookup_stats():
+    with _lock:
+        return {'exact_entries': len(_exact), 'template_entries': len(_templates), 'learned_entries': len(_learned)}
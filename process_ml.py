@@ -1,27 +1,207 @@
-from sentence_transformers import SentenceTransformer
-from joblib import load
- # Initialize the BERT model for embeddings
-model = SentenceTransformer('all-MiniLM-L6-v2') #we dont want to load the model everytime we call the function
-# Load the saved classifier
+import hashlib
+import os
+import threading
+import time
+import numpy as np
+import metrics
+from embedding_cache import EmbeddingCache, file_fingerprint, log_template
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# 'torch', 'int8', 'onnx' or 'onnx-int8' (see embedding_backend.py); the onnx
+# backends load EMBEDDING_MODEL_DIR, written by `python embedding_backend.py export`
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_MODEL_DIR = os.getenv("EMBEDDING_MODEL_DIR", "models/minilm")
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", 0))  # 0 keeps the model's limit (256 tokens)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", 0))  # intra-op threads, 0 for the runtime default
 classifier_path = r"models/log_classification_model_knn.joblib"  # Use raw string and forward slashes
-classifier = load(classifier_path)
-    
-def classify_with_ml(log_msg):
+# 'sklearn' runs the joblib KNN as is; 'vector' answers the same queries from a
+# memory-mapped float32 copy of its training set (see knn_index.py)
+ML_BACKEND = os.getenv("ML_BACKEND", "sklearn")
+KNN_INDEX_DIR = os.getenv("KNN_INDEX_DIR", "models/knn_index")
+
+# The BERT model and the classifier are loaded on first use (or by load_models()),
+# so importing this module stays cheap for regex-only work
+model = None
+classifier = None
+# Cached labels are only reused while the classifier file is unchanged
+model_version = None
+_classifier_mtime = None
+_load_lock = threading.Lock()
+
+
+def get_model():
+    global model
+    if model is None:
+        with _load_lock:
+            if model is None:
+                started = time.perf_counter()
+                from embedding_backend import load_encoder
+                model = load_encoder(EMBEDDING_BACKEND, EMBEDDING_MODEL, EMBEDDING_MODEL_DIR,
+                                     EMBEDDING_MAX_SEQ_LENGTH, EMBEDDING_THREADS)
+                metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - started, model="embedding")
+    return model
+
+
+def get_classifier():
+    """Return the KNN classifier, loading it on first use and whenever the joblib file changes."""
+    global classifier, model_version, _classifier_mtime
+    mtime = os.stat(classifier_path).st_mtime_ns
+    if classifier is None or mtime != _classifier_mtime:
+        with _load_lock:
+            if classifier is None or mtime != _classifier_mtime:
+                started = time.perf_counter()
+                if ML_BACKEND == "vector":
+                    from knn_index import VectorKNN
+                    classifier = VectorKNN.from_joblib(classifier_path, KNN_INDEX_DIR)
+                else:
+                    from joblib import load
+                    classifier = load(classifier_path)
+                model_version = file_fingerprint(classifier_path)
+                metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - started, model="classifier")
+                _classifier_mtime = mtime
+    return classifier
+
+
+_disk_version = None
+
+
+def current_model_version():
+    """Version of the classifier file on disk, without loading it; the inference server's once it answered."""
+    global _disk_version
+    if ML_SERVER_SOCKET and _server_versions:
+        return _server_versions[0]
+    mtime = os.stat(classifier_path).st_mtime_ns
+    if _disk_version is None or _disk_version[0] != mtime:
+        _disk_version = (mtime, file_fingerprint(classifier_path))
+    return _disk_version[1]
+
+
+def embedding_version():
+    """Names the embeddings: backends and sequence limits give slightly different vectors."""
+    if ML_SERVER_SOCKET and _server_versions:
+        return _server_versions[1]  # the daemon's embeddings, whatever this process is configured with
+    version = EMBEDDING_MODEL
+    if EMBEDDING_BACKEND != "torch":
+        version += f"+{EMBEDDING_BACKEND}"
+    if EMBEDDING_MAX_SEQ_LENGTH:
+        version += f"@{EMBEDDING_MAX_SEQ_LENGTH}"
+    return version
+
+
+def load_models():
+    if ML_SERVER_SOCKET:
+        return  # the inference server holds them
+    get_model()
+    get_classifier()
+
+
+# Unix socket of inference_server.py; when set, this process sends its messages
+# there instead of loading the models itself
+ML_SERVER_SOCKET = os.getenv("ML_SERVER_SOCKET") or None
+_server_client = None
+_server_down = False
+# (model_version, embedding_version) of the inference server's last answer
+_server_versions = None
+
 
-    # Get embedding for the log message
-    embedding = model.encode([log_msg])[0]
-    
-    # Getting probabilities of each class of a message
-    probabilities = classifier.predict_proba([embedding])[0]
-    
-    if max(probabilities) < 0.5:
-        prediction = "Unknown"
-    else:
-        # Predict using the loaded model 
-        prediction = classifier.predict([embedding])[0]
-        
-    
-    return prediction
+def _classify_on_server(log_msgs):
+    # None when the daemon is not running: this process then loads the models itself
+    global _server_client, _server_down, _server_versions, model_version
+    from inference_server import InferenceClient
+    if _server_client is None:
+        _server_client = InferenceClient(ML_SERVER_SOCKET)
+    try:
+        labels, confidences, model_version, embedding = _server_client.classify(log_msgs)
+    except ConnectionError as e:
+        metrics.ML_SERVER_FALLBACKS.inc()
+        if not _server_down:
+            print(f"{e}; classifying in process {os.getpid()} until it is back")
+        _server_down = True
+        _server_versions = None  # stamps come from this process's own models again
+        return None
+    _server_down = False
+    _server_versions = (model_version, embedding)
+    return labels, confidences
+
+
+# How many messages go through the transformer in one encode() call
+ML_BATCH_SIZE = int(os.getenv("ML_BATCH_SIZE", 256))
+# Below this class probability the prediction is reported as "Unknown"
+CONFIDENCE_THRESHOLD = 0.5
+
+# Template -> label cache; ML_CACHE_SIZE=0 turns it off, ML_CACHE_PATH keeps it on disk
+ML_CACHE_SIZE = int(os.getenv("ML_CACHE_SIZE", 100000))
+ML_CACHE_PATH = os.getenv("ML_CACHE_PATH") or None
+# Stored embeddings are only reused by the backend that computed them
+ml_cache = EmbeddingCache(maxsize=ML_CACHE_SIZE, path=ML_CACHE_PATH,
+                          table="ml_cache" if embedding_version() == EMBEDDING_MODEL else
+                          "ml_cache_" + hashlib.sha1(embedding_version().encode()).hexdigest()[:8])
+
+
+def _cache_key(log_msg):
+    if ML_CACHE_SIZE > 0 or ML_CACHE_PATH:
+        return log_template(log_msg)
+    return log_msg
+
+
+def _predict(embeddings):
+    # One neighbour search per batch: the label is the most probable class,
+    # which is exactly what classifier.predict() would return
+    classifier = get_classifier()
+    probabilities = classifier.predict_proba(embeddings)
+    predictions = classifier.classes_[probabilities.argmax(axis=1)]
+    confidences = probabilities.max(axis=1)
+    labels = np.where(confidences >= CONFIDENCE_THRESHOLD, predictions, "Unknown").tolist()
+    return labels, confidences.tolist()
+
+
+def classify_with_ml_batch(log_msgs, batch_size=ML_BATCH_SIZE, return_confidence=False):
+    """Classify many log messages, encoding them in chunks of batch_size.
+
+    With return_confidence, each result is a (label, probability) pair; the
+    probability is None for answers served from the cache. With
+    ML_SERVER_SOCKET set, the inference server answers instead.
+    """
+    if ML_SERVER_SOCKET and log_msgs:
+        answers = _classify_on_server(log_msgs)
+        if answers is not None:
+            return list(zip(*answers)) if return_confidence else answers[0]
+    get_classifier()
+    keys = [_cache_key(log_msg) for log_msg in log_msgs]
+    labels = ml_cache.get_labels(list(dict.fromkeys(keys)), model_version)
+    confidences = {}
+
+    # The first message seen for each uncached template stands in for all of them
+    pending = {}
+    for key, log_msg in zip(keys, log_msgs):
+        if key not in labels:
+            pending.setdefault(key, log_msg)
+
+    # Embeddings stored on disk survive a classifier change, only the KNN has to re-run
+    stored = ml_cache.get_embeddings(list(pending))
+    if stored:
+        stored_keys = list(stored)
+        stored_labels, stored_confidences = _predict(np.vstack([stored[key] for key in stored_keys]))
+        ml_cache.put(stored_keys, stored_labels, model_version)
+        labels.update(zip(stored_keys, stored_labels))
+        confidences.update(zip(stored_keys, stored_confidences))
+
+    to_encode = [key for key in pending if key not in stored]
+    for start in range(0, len(to_encode), batch_size):
+        chunk = to_encode[start:start + batch_size]
+        embeddings = get_model().encode([pending[key] for key in chunk], batch_size=batch_size)
+        chunk_labels, chunk_confidences = _predict(embeddings)
+        ml_cache.put(chunk, chunk_labels, model_version, embeddings)
+        labels.update(zip(chunk, chunk_labels))
+        confidences.update(zip(chunk, chunk_confidences))
+
+    if return_confidence:
+        return [(labels[key], confidences.get(key)) for key in keys]
+    return [labels[key] for key in keys]
+
+
+def classify_with_ml(log_msg):
+    return classify_with_ml_batch([log_msg])[0]
 
 if __name__ =="__main__":
     logs = [
@@ -32,6 +212,6 @@ if __name__ =="__main__":
         "Multiple login failures occurred on user 6454 account",
         "Server A790 was restarted unexpectedly during the process of data transfer"
     ]
-    for log in logs:
-        label = classify_with_ml(log)  # Fix function name
+    for log, label in zip(logs, classify_with_ml_batch(logs)):
         print(log, "->", label)
+    print("Cache:", ml_cache.stats())
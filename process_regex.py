@@ -1,21 +1,134 @@
-
+import hashlib
+import json
 import re
+import threading
+
+# Rules are checked in this order; the first pattern that matches decides the label
+REGEX_PATTERNS = {
+    r"User User\d+ logged (in|out).": "User Action",
+    r"Backup (started|ended) at .*": "System Notification",
+    r"Backup completed successfully.": "System Notification",
+    r"System updated to version .*": "System Notification",
+    r"File .* uploaded successfully by user .*": "System Notification",
+    r"Disk cleanup completed successfully.": "System Notification",
+    r"System reboot initiated by user .*": "System Notification",
+    r"Account with ID .* created by .*": "User Action"
+}
+
+_REGEX_METACHARS = set("\\.^$*+?{}[]()|")
+
+_rules_lock = threading.Lock()
+_compiled_rules = []  # [(lowercase literal prefix, compiled pattern, label)] in precedence order
+RULES_VERSION = None  # changes whenever a pattern, its label or the rule order changes
+
+
+def _has_top_level_alternation(pattern):
+    depth, escaped, in_class = 0, False, False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+
+def _literal_prefix(pattern):
+    # The plain text every match has to start with, e.g. "backup " for "Backup (started|ended) at .*"
+    if _has_top_level_alternation(pattern):
+        return ""
+    prefix = []
+    for char in pattern:
+        if char in _REGEX_METACHARS:
+            break
+        prefix.append(char)
+    if prefix and pattern[len(prefix):len(prefix) + 1] in ("*", "?", "{"):
+        prefix.pop()  # the last literal is optional or repeated
+    return "".join(prefix).lower()
+
+
+def load_patterns(patterns=None):
+    """Compile the regex rules once; call again whenever the rules change."""
+    global REGEX_PATTERNS, _compiled_rules, RULES_VERSION
+    if patterns is None:
+        patterns = REGEX_PATTERNS
+    compiled = [
+        (_literal_prefix(pattern), re.compile(pattern, re.IGNORECASE), label)
+        for pattern, label in patterns.items()
+    ]
+    version = hashlib.sha1(json.dumps(list(patterns.items())).encode()).hexdigest()[:16]
+    with _rules_lock:
+        REGEX_PATTERNS = dict(patterns)
+        _compiled_rules = compiled
+        RULES_VERSION = version
+
+
 def classify_with_regex(log_message):
-    regex_patterns = {
-        r"User User\d+ logged (in|out).": "User Action",
-        r"Backup (started|ended) at .*": "System Notification",
-        r"Backup completed successfully.": "System Notification",
-        r"System updated to version .*": "System Notification",
-        r"File .* uploaded successfully by user .*": "System Notification",
-        r"Disk cleanup completed successfully.": "System Notification",
-        r"System reboot initiated by user .*": "System Notification",
-        r"Account with ID .* created by .*": "User Action"
-    }
-    for pattern, label in regex_patterns.items():
-        if re.search(pattern, log_message,re.IGNORECASE):
+    # Cheap substring prefilter: a rule's regex only runs when its literal prefix
+    # occurs in the message. Non-ASCII text skips the prefilter because
+    # re.IGNORECASE folds a few characters differently from str.lower()
+    lowered = log_message.lower() if log_message.isascii() else None
+    for prefix, pattern, label in _compiled_rules:
+        if lowered is not None and prefix not in lowered:
+            continue
+        if pattern.search(log_message):
             return label
     return None
 
+
+def classify_each_with_regex(log_messages):
+    """classify_with_regex over each message of a pandas Series; rows no rule matches are None.
+
+    A plain per-row loop: running each rule over the Series with Series.str
+    measured about twice as slow, since every rule rescans the remaining rows.
+    """
+    import pandas as pd
+    labels = [
+        classify_with_regex(message) if isinstance(message, str) else None
+        for message in log_messages.to_numpy()
+    ]
+    return pd.Series(labels, index=log_messages.index, dtype=object)
+
+
+load_patterns()
+
+
+def _benchmark(csv_path="dataset/synthetic_logs.csv", repeat=20):
+    # Micro-benchmark of the compiled engine against the original per-call loop
+    import timeit
+    import pandas as pd
+
+    def reference(log_message):
+        for pattern, label in REGEX_PATTERNS.items():
+            if re.search(pattern, log_message, re.IGNORECASE):
+                return label
+        return None
+
+    messages = pd.read_csv(csv_path)["log_message"]
+    expected = [reference(message) for message in messages]
+    assert [classify_with_regex(message) for message in messages] == expected
+    assert classify_each_with_regex(messages).tolist() == expected
+
+    timings = {
+        "reference loop": lambda: [reference(message) for message in messages],
+        "classify_with_regex": lambda: [classify_with_regex(message) for message in messages],
+        "classify_each_with_regex": lambda: classify_each_with_regex(messages),
+    }
+    print(f"Regex micro-benchmark on {csv_path} ({len(messages)} messages, best of {repeat})")
+    for name, func in timings.items():
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name:>28}: {best * 1000:8.2f} ms  ({len(messages) / best:,.0f} msgs/s)")
+
+
 if __name__ == "__main__":
     # Test cases
     test_cases = [
@@ -47,4 +160,6 @@ if __name__ == "__main__":
         print(f"Got: {result}")
         print("-" * 50)
 
-    print(f"\nOverall test result: {'ALL PASSED' if all_passed else 'SOME TESTS FAILED'}")
\ No newline at end of file
+    print(f"\nOverall test result: {'ALL PASSED' if all_passed else 'SOME TESTS FAILED'}")
+
+    _benchmark()
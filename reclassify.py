@@ -0,0 +1,353 @@
+"""Re-classify stored uploads after the model, the rules or the lookup seed change.
+
+Every result row records the tier that decided its label and that tier's
+classify.tier_versions() stamp. A run re-classifies only the rows whose stamp
+is out of date:
+
+- rows decided by regex go stale when the rules or the lookup seed change,
+  but not when only the ML model does;
+- rows decided by ML go stale when any of the three change;
+- LegacyCRM rows keep their LLM answers.
+
+Runs work through a table in id order, in batches that commit their progress,
+so a run interrupted by a restart picks up where it stopped.
+
+    python reclassify.py --all            # every registered upload with stale rows
+    python reclassify.py my_upload --dry-run
+"""
+import json
+import os
+import uuid
+from collections import Counter
+
+import pandas as pd
+
+import columnar
+import db
+import jobs
+import rollups
+
+RECLASSIFY_BATCH_SIZE = int(os.getenv('RECLASSIFY_BATCH_SIZE', 5000))
+# Tiers whose rows are re-run when their stamp changes; LLM answers are kept
+RERUN_TIERS = ('lookup', 'regex', 'ml')
+# A running run whose updated_at is older than this lost its process and is taken
+# over; every committed batch (or written frame, for columnar tables) renews it
+RECLASSIFY_LEASE_SECONDS = int(os.getenv('RECLASSIFY_LEASE_SECONDS', 600))
+
+
+def init_reclassify_table(db_path):
+    conn = db.connect(db_path)
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS reclassify_runs (
+                id TEXT PRIMARY KEY,
+                table_name TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                versions TEXT,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                rows_reclassified INTEGER NOT NULL DEFAULT 0,
+                rows_changed INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        ''')
+
+
+def _stale_condition(versions):
+    # Rows of unknown provenance (stored before tiers were recorded) are re-run,
+    # except LegacyCRM rows, which the LLM answered
+    condition = "(tier IS NULL AND source IS NOT 'LegacyCRM')"
+    for tier in RERUN_TIERS:
+        condition += f" OR (tier = '{tier}' AND label_version IS NOT ?)"
+    return f'({condition})', tuple(versions[tier] for tier in RERUN_TIERS)
+
+
+def _is_stale(tiers, stamps, sources, versions):
+    return [
+        (tier is None or pd.isna(tier)) and source != 'LegacyCRM'
+        or tier in RERUN_TIERS and stamp != versions[tier]
+        for tier, stamp, source in zip(tiers, stamps, sources)
+    ]
+
+
+def stale_rows(conn, table_name, versions=None):
+    """How many rows of a result table the current versions would re-run; None if the table is gone.
+
+    Only reads: a table without the provenance columns yet has all its rows of
+    unknown provenance.
+    """
+    from classify import tier_versions
+    versions = versions or tier_versions()
+    table = columnar.open_table(table_name)
+    if table is not None:
+        return sum(sum(_is_stale(frame.get('tier', [None] * len(frame)), frame.get('label_version', [None] * len(frame)),
+                                 frame['source'], versions))
+                   for frame in table.iter_frames())
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')}
+    if not columns:
+        return None
+    if not set(jobs.PROVENANCE_COLUMNS) <= columns:
+        # What _stale_condition gives once the columns are added, all empty
+        return conn.execute(f"SELECT COUNT(*) FROM {table_name} WHERE source IS NOT 'LegacyCRM'").fetchone()[0]
+    condition, params = _stale_condition(versions)
+    return conn.execute(f'SELECT COUNT(*) FROM {table_name} WHERE {condition}', params).fetchone()[0]
+
+
+def create_run(db_path, table_name):
+    """Queue a run for a result table, or return the unfinished one it already has."""
+    conn = db.connect(db_path)
+    with conn:
+        row = conn.execute("SELECT id FROM reclassify_runs WHERE table_name = ? AND status IN ('queued', 'running')",
+                           (table_name,)).fetchone()
+        if row:
+            return row[0]
+        run_id = uuid.uuid4().hex
+        conn.execute('''
+            INSERT INTO reclassify_runs (id, table_name, status, created_at, updated_at)
+            VALUES (?, ?, 'queued', ?, ?)
+        ''', (run_id, table_name, jobs._now(), jobs._now()))
+    return run_id
+
+
+def get_run(db_path, run_id):
+    rows = db.fetch_dicts(db.connect(db_path), 'SELECT * FROM reclassify_runs WHERE id = ?', (run_id,))
+    return rows[0] if rows else None
+
+
+def _claim_run(conn, run_id):
+    # Queued runs, and running ones whose process stopped renewing the lease
+    with conn:
+        cursor = conn.execute('''
+            UPDATE reclassify_runs SET status = 'running', updated_at = ?
+            WHERE id = ? AND (status = 'queued' OR status = 'running' AND updated_at < ?)
+        ''', (jobs._now(), run_id, jobs._lease_cutoff(RECLASSIFY_LEASE_SECONDS)))
+    return cursor.rowcount == 1
+
+
+def _renew_lease(conn, run_id):
+    with conn:
+        conn.execute('UPDATE reclassify_runs SET updated_at = ? WHERE id = ?', (jobs._now(), run_id))
+
+
+def _finish_run(conn, run_id, status, error=None):
+    # A run cancelled meanwhile (its upload was deleted) stays cancelled
+    with conn:
+        conn.execute("UPDATE reclassify_runs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                     (status, error, jobs._now(), run_id))
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _check_cancelled(conn, run_id):
+    if conn.execute('SELECT status FROM reclassify_runs WHERE id = ?', (run_id,)).fetchone()[0] == 'cancelled':
+        raise _Cancelled()
+
+
+def _apply_count_changes(conn, table_name, old_labels, new_labels, ids):
+    # Keep upload_label_counts right after every batch; first_id is made exact at the end
+    changes = {}
+    for old, new, row_id in zip(old_labels, new_labels, ids):
+        if old != new:
+            if old is not None:
+                count, first = changes.get(old, (0, row_id))
+                changes[old] = (count - 1, first)
+            if new is not None:
+                count, first = changes.get(new, (0, row_id))
+                changes[new] = (count + 1, min(first, row_id))
+    conn.executemany('''
+        INSERT INTO upload_label_counts (table_name, target_label, count, first_id) VALUES (?, ?, ?, ?)
+        ON CONFLICT (table_name, target_label)
+        DO UPDATE SET count = count + excluded.count, first_id = MIN(first_id, excluded.first_id)
+    ''', [(table_name, label, count, first) for label, (count, first) in changes.items()])
+    conn.execute('DELETE FROM upload_label_counts WHERE table_name = ? AND count <= 0', (table_name,))
+
+
+def _reclassify_sqlite(conn, run, versions):
+    from classify import classify, tier_versions
+    table_name = run['table_name']
+    jobs.add_provenance_columns(conn, table_name)
+    with conn:
+        # Rows stored before provenance was recorded: LegacyCRM ones were LLM answers
+        conn.execute(f"UPDATE {table_name} SET tier = 'llm', label_version = ? WHERE tier IS NULL AND source = 'LegacyCRM'",
+                     (versions['llm'],))
+    jobs.get_label_counts(conn, table_name)  # make sure the summary exists before adjusting it
+
+    last_id = run['last_id']
+    while True:
+        condition, params = _stale_condition(versions)
+        rows = conn.execute(f'''
+            SELECT id, source, log_message, target_label FROM {table_name}
+            WHERE id > ? AND {condition} ORDER BY id LIMIT ?
+        ''', (last_id, *params, RECLASSIFY_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        _check_cancelled(conn, run['id'])
+        ids = [row[0] for row in rows]
+        labels, tiers = classify([(source, log_message) for _, source, log_message, _ in rows], return_tiers=True)
+        versions = tier_versions()
+        last_id = ids[-1]
+        with conn:
+            conn.executemany(f'UPDATE {table_name} SET target_label = ?, tier = ?, label_version = ? WHERE id = ?',
+                             [(label, tier, versions.get(tier), row_id) for label, tier, row_id in zip(labels, tiers, ids)])
+            old_labels = [row[3] for row in rows]
+            _apply_count_changes(conn, table_name, old_labels, labels, ids)
+            rollups.apply_changes(conn, table_name, [row[1] for row in rows], old_labels, labels)
+            changed = sum(old != new for old, new in zip(old_labels, labels))
+            conn.execute('''
+                UPDATE reclassify_runs
+                SET last_id = ?, rows_reclassified = rows_reclassified + ?, rows_changed = rows_changed + ?,
+                    versions = ?, updated_at = ?
+                WHERE id = ?
+            ''', (last_id, len(rows), changed, json.dumps(versions), jobs._now(), run['id']))
+
+
+def _reclassify_columnar(conn, run, versions):
+    # Columnar tables are immutable: the run writes a new copy with the stale
+    # rows re-classified and swaps it in, so an interrupted run starts over
+    from classify import classify, tier_versions
+    table_name = run['table_name']
+    table = columnar.open_table(table_name)
+    counts = {'rows': 0, 'changed': 0}
+    label_counts = Counter()  # the new table's rollups
+
+    def frames():
+        for frame in table.iter_frames(RECLASSIFY_BATCH_SIZE):
+            _check_cancelled(conn, run['id'])
+            for column in jobs.PROVENANCE_COLUMNS:
+                if column not in frame:
+                    frame[column] = None
+            legacy = (frame['tier'].isna() & (frame['source'] == 'LegacyCRM')).to_numpy()
+            frame.loc[legacy, ['tier', 'label_version']] = ['llm', versions['llm']]
+            stale = _is_stale(frame['tier'], frame['label_version'], frame['source'], versions)
+            if any(stale):
+                rows = frame[stale]
+                labels, tiers = classify(list(zip(rows['source'], rows['log_message'])), return_tiers=True)
+                current = tier_versions()
+                counts['rows'] += len(rows)
+                counts['changed'] += sum(old != new for old, new in zip(rows['target_label'], labels))
+                frame.loc[stale, 'target_label'] = labels
+                frame.loc[stale, 'tier'] = tiers
+                frame.loc[stale, 'label_version'] = [current.get(tier) for tier in tiers]
+            rollups.count_chunk(label_counts, frame)
+            _renew_lease(conn, run['id'])
+            yield frame.drop(columns='id')
+
+    summary = columnar.write_table(table_name, frames())
+    try:
+        _check_cancelled(conn, run['id'])
+    except _Cancelled:
+        columnar.drop_table(table_name)  # the upload was deleted while the copy was written
+        raise
+    jobs.write_label_counts(conn, table_name, summary)
+    with conn:
+        rollups.replace_upload(conn, table_name, label_counts)
+        conn.execute('''
+            UPDATE reclassify_runs SET rows_reclassified = ?, rows_changed = ?, versions = ?, updated_at = ?
+            WHERE id = ?
+        ''', (counts['rows'], counts['changed'], json.dumps(versions), jobs._now(), run['id']))
+
+
+def run_reclassify(db_path, run_id):
+    """Work through a queued run; runs in the job pool or from the command line."""
+    from classify import tier_versions
+    conn = db.connect(db_path)
+    if not _claim_run(conn, run_id):
+        return
+    run = get_run(db_path, run_id)
+    try:
+        versions = tier_versions()
+        if columnar.exists(run['table_name']):
+            _reclassify_columnar(conn, run, versions)
+        else:
+            _reclassify_sqlite(conn, run, versions)
+            jobs.summarize_table(conn, run['table_name'])
+        _finish_run(conn, run_id, 'done')
+    except _Cancelled:
+        pass
+    except Exception as e:
+        # Progress so far is committed; requeue the run (see resume_runs) to continue
+        _finish_run(conn, run_id, 'failed', str(e))
+
+
+def submit_run(db_path, run_id):
+    jobs._get_executor().submit(run_reclassify, db_path, run_id)
+
+
+def enqueue_stale(db_path, submit=True):
+    """Queue a run for every registered upload that has stale rows; returns the run ids.
+
+    A table whose run is still running keeps it: that run is taken over once its lease expires.
+    """
+    from classify import tier_versions
+    conn = db.connect(db_path)
+    versions = tier_versions()
+    run_ids = []
+    for (table_name,) in conn.execute('SELECT DISTINCT table_name FROM uploads').fetchall():
+        if stale_rows(conn, table_name, versions):
+            run_ids.append(create_run(db_path, table_name))
+            if submit:
+                _submit_or_watch(db_path, run_ids[-1])
+    return run_ids
+
+
+def _submit_or_watch(db_path, run_id):
+    # A running run may belong to a live process; it is resubmitted once its lease expires
+    if get_run(db_path, run_id)['status'] == 'running':
+        jobs.watch_lease(db_path, 'reclassify_runs', run_id, submit_run, RECLASSIFY_LEASE_SECONDS)
+    else:
+        submit_run(db_path, run_id)
+
+
+def resume_runs(db_path, interrupted=False, submit=True):
+    """Resubmit queued runs, and running ones once their lease expires; returns the run ids.
+
+    With interrupted, runs left running or failed by a previous process are
+    requeued at once; only pass it when no other process is working on them.
+    """
+    conn = db.connect(db_path)
+    if interrupted:
+        with conn:
+            conn.execute("UPDATE reclassify_runs SET status = 'queued', error = NULL WHERE status IN ('running', 'failed')")
+    run_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM reclassify_runs WHERE status IN ('queued', 'running') ORDER BY created_at")]
+    if submit:
+        for run_id in run_ids:
+            _submit_or_watch(db_path, run_id)
+    return run_ids
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Re-classify the stale rows of stored uploads.')
+    parser.add_argument('tables', nargs='*', help='result tables to re-classify')
+    parser.add_argument('--all', action='store_true', help='every registered upload with stale rows')
+    parser.add_argument('--resume', action='store_true', help='continue interrupted and failed runs')
+    parser.add_argument('--dry-run', action='store_true', help='only report how many rows are stale')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db'))
+    args = parser.parse_args()
+
+    connection = db.connect(args.db)
+    tables = list(args.tables)
+    if args.all:
+        tables += [row[0] for row in connection.execute('SELECT DISTINCT table_name FROM uploads')]
+
+    if args.dry_run:
+        # Reads only, nothing is created or migrated
+        for name in tables:
+            count = stale_rows(connection, name)
+            print(f'{name}: no such table, skipped' if count is None else f'{name}: {count} stale rows')
+        raise SystemExit
+
+    init_reclassify_table(args.db)
+    rollups.init_rollup_table(args.db)
+    pending = resume_runs(args.db, interrupted=True, submit=False) if args.resume else []
+    pending += [create_run(args.db, name) for name in tables if stale_rows(connection, name)]
+    for run_id in dict.fromkeys(pending):
+        run_reclassify(args.db, run_id)
+        run = get_run(args.db, run_id)
+        print(f"{run['table_name']}: {run['status']}, {run['rows_reclassified']} rows re-classified, "
+              f"{run['rows_changed']} labels changed" + (f" ({run['error']})" if run['error'] else ''))
@@ -0,0 +1,146 @@
+"""Per-user label counts across uploads, kept up to date as uploads change.
+
+user_label_rollups holds one row per (user, upload, day, source, label) with
+its row count. jobs.run_job adds an upload's rows in the transaction that
+registers it, reclassify adjusts them as labels change, and deleting an
+upload removes them, so the dashboard never has to read the result tables.
+The day is the upload's date: stored rows keep no timestamp of their own.
+uploads.rollups_at records when an upload's rollups were first written;
+uploads without it are counted by backfill().
+"""
+from collections import Counter
+
+import pandas as pd
+
+import columnar
+import db
+
+# How dashboard() groups days: the number of characters of the YYYY-MM-DD day kept
+BUCKETS = {'day': 10, 'month': 7, 'year': 4}
+
+
+def init_rollup_table(db_path):
+    conn = db.connect(db_path)
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_label_rollups (
+                username TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                day TEXT NOT NULL,
+                source TEXT NOT NULL,
+                target_label TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (username, table_name, day, source, target_label)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_user_label_rollups_table ON user_label_rollups (table_name)')
+        # uploads tables created before rollups existed
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(uploads)')}
+        if columns and 'rollups_at' not in columns:
+            conn.execute('ALTER TABLE uploads ADD COLUMN rollups_at TEXT')
+
+
+def count_chunk(counts, chunk):
+    """Add a labelled chunk's rows to counts, a Counter of (source, label)."""
+    grouped = chunk.fillna({'source': ''}).groupby(['source', 'target_label'], dropna=True).size()
+    counts.update({key: int(count) for key, count in grouped.items()})
+
+
+def add_upload(conn, username, table_name, upload_date, counts):
+    """Insert an upload's counts; call inside the transaction that registers the upload."""
+    conn.executemany('''
+        INSERT INTO user_label_rollups (username, table_name, day, source, target_label, count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (username, table_name, day, source, target_label) DO UPDATE SET count = count + excluded.count
+    ''', [(username, table_name, upload_date[:10], source, label, count)
+          for (source, label), count in counts.items() if count])
+
+
+def apply_changes(conn, table_name, sources, old_labels, new_labels):
+    """Move re-classified rows between labels; call inside the transaction that updates them."""
+    changes = Counter()
+    for source, old, new in zip(sources, old_labels, new_labels):
+        if old != new:
+            source = '' if source is None or pd.isna(source) else source
+            if old is not None:
+                changes[source, old] -= 1
+            if new is not None:
+                changes[source, new] += 1
+    if not any(changes.values()):
+        return
+    # Uploads without rollups yet (temporary ones, or stored before rollups
+    # existed) are left to backfill(), which counts them as they are then
+    owner = conn.execute('SELECT username, upload_date FROM uploads WHERE table_name = ? AND rollups_at IS NOT NULL',
+                         (table_name,)).fetchone()
+    if owner is None:
+        return
+    add_upload(conn, owner[0], table_name, owner[1], changes)
+    conn.execute('DELETE FROM user_label_rollups WHERE table_name = ? AND count <= 0', (table_name,))
+
+
+def replace_upload(conn, table_name, counts):
+    """Replace an upload's rollups with counts; call inside a transaction."""
+    owner = conn.execute('SELECT username, upload_date FROM uploads WHERE table_name = ?', (table_name,)).fetchone()
+    delete_upload(conn, table_name)
+    if owner is not None:
+        add_upload(conn, owner[0], table_name, owner[1], counts)
+        conn.execute('UPDATE uploads SET rollups_at = COALESCE(rollups_at, ?) WHERE table_name = ?',
+                     (pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'), table_name))
+
+
+def delete_upload(conn, table_name):
+    conn.execute('DELETE FROM user_label_rollups WHERE table_name = ?', (table_name,))
+
+
+def rebuild(conn, table_name):
+    """Recount an upload from its result table, e.g. for uploads stored before rollups existed.
+
+    Counts under the write lock, so no reclassify batch can commit between the
+    count and the replacement.
+    """
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        counts = Counter()
+        table = columnar.open_table(table_name)
+        if table is not None:
+            for frame in table.iter_frames():
+                count_chunk(counts, frame)
+        elif conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone():
+            counts.update({(source, label): count for source, label, count in conn.execute(f'''
+                SELECT COALESCE(source, ''), target_label, COUNT(*) FROM {table_name}
+                WHERE target_label IS NOT NULL GROUP BY 1, 2
+            ''')})
+        replace_upload(conn, table_name, counts)
+
+
+def backfill(conn, username):
+    """Count the user's uploads that were stored before rollups existed."""
+    missing = conn.execute('SELECT table_name FROM uploads WHERE username = ? AND rollups_at IS NULL',
+                           (username,)).fetchall()
+    for (table_name,) in missing:
+        rebuild(conn, table_name)
+
+
+def dashboard(conn, username, bucket='day'):
+    """A user's label counts in total, per time bucket, per source and per upload."""
+    width = BUCKETS[bucket]
+
+    def grouped(column):
+        result = {}
+        for key, label, count in conn.execute(f'''
+            SELECT {column}, target_label, SUM(count) FROM user_label_rollups
+            WHERE username = ? GROUP BY 1, 2 ORDER BY 1, 3 DESC
+        ''', (username,)):
+            result.setdefault(key, {})[label] = count
+        return result
+
+    totals = dict(conn.execute('''
+        SELECT target_label, SUM(count) FROM user_label_rollups WHERE username = ? GROUP BY 1 ORDER BY 2 DESC
+    ''', (username,)).fetchall())
+    return {
+        'total_logs': sum(totals.values()),
+        'label_counts': totals,
+        'by_time': grouped(f'substr(day, 1, {width})'),
+        'by_source': grouped('source'),
+        'by_upload': grouped('table_name'),
+    }
@@ -0,0 +1,67 @@
+import pytest
+
+import classify
+
+
+@pytest.fixture
+def tiers(monkeypatch):
+    # Stand-ins for the model tiers that record what they were asked
+    calls = {'ml': [], 'llm': []}
+
+    def ml(messages, return_confidence=False):
+        calls['ml'].append(list(messages))
+        return [(f"ml:{message}", 0.5) for message in messages]
+
+    def llm(messages):
+        calls['llm'].append(list(messages))
+        return [f"llm:{message}" for message in messages]
+
+    monkeypatch.setattr(classify, "classify_with_ml_batch", ml)
+    monkeypatch.setattr(classify, "classify_with_llm_batch", llm)
+    monkeypatch.setattr(classify, "ENABLED_TIERS", frozenset({"regex", "ml", "llm"}))
+    return calls
+
+
+def test_repeated_rows_are_classified_once(tiers):
+    logs = [
+        ("ModernHR", "disk on fire"),
+        ("ModernCRM", "User User1 logged in."),
+        ("ModernHR", "disk on fire"),
+        ("LegacyCRM", "disk on fire"),
+        ("LegacyCRM", "disk on fire"),
+        ("ModernHR", "queue stalled"),
+        ("ModernCRM", "User User1 logged in."),
+    ]
+    labels, report = classify._classify(logs)
+
+    assert labels == ["ml:disk on fire", "User Action", "ml:disk on fire", "llm:disk on fire", "llm:disk on fire",
+                      "ml:queue stalled", "User Action"]
+    assert report['tiers'] == ["ml", "regex", "ml", "llm", "llm", "ml", "regex"]
+    assert tiers['ml'] == [["disk on fire", "queue stalled"]]
+    assert tiers['llm'] == [["disk on fire"]]
+    assert (report['rows'], report['unique_rows']) == (7, 4)
+    assert report['counts'] == {'lookup': 0, 'regex': 1, 'ml': 2, 'llm': 1}
+
+
+def test_unique_rows_keep_their_order(tiers):
+    logs = [("ModernHR", f"message {i}") for i in range(5)]
+    labels, report = classify._classify(logs)
+    assert labels == [f"ml:message {i}" for i in range(5)]
+    assert (report['rows'], report['unique_rows']) == (5, 5)
+
+
+def test_empty_input(tiers):
+    labels, report = classify._classify([])
+    assert labels == [] and report['tiers'] == []
+    assert (report['rows'], report['unique_rows']) == (0, 0)
+
+
+def test_classify_csv_streams_to_output_file(tiers, tmp_path):
+    source = tmp_path / "logs.csv"
+    source.write_text("source,log_message\n" + "".join(f"ModernHR,event {i % 7}\n" for i in range(25)))
+    output = tmp_path / "out.csv"
+    assert classify.classify_csv(str(source), str(output), chunksize=10, workers=1) == str(output)
+    written = output.read_text().splitlines()
+    assert written[0] == "source,log_message,target_label" and len(written) == 26
+    assert classify.classify_csv(str(source), chunksize=10, workers=1)["target_label"].tolist() == \
+        [f"ml:event {i % 7}" for i in range(25)]
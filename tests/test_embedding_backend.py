@@ -0,0 +1,50 @@
+import numpy as np
+
+from embedding_backend import OnnxEncoder
+
+
+class Encoding:
+    def __init__(self, tokens):
+        self.ids = list(range(1, tokens + 1))
+        self.attention_mask = [1] * tokens
+        self.type_ids = [0] * tokens
+
+
+class Tokenizer:
+    # One token per word, so short strings can be long in tokens and the other way round
+    def encode_batch(self, sentences):
+        return [Encoding(len(sentence.split())) for sentence in sentences]
+
+
+class Session:
+    def __init__(self):
+        self.shapes = []
+
+    def run(self, outputs, feed):
+        self.shapes.append(feed["input_ids"].shape)
+        # Each token's hidden state is its id, so the mean pooling of a sentence is (tokens + 1) / 2
+        return [np.repeat(feed["input_ids"][:, :, None].astype(np.float32), 2, axis=2)]
+
+
+def encoder():
+    # OnnxEncoder without onnxruntime or tokenizer files
+    encoder = OnnxEncoder.__new__(OnnxEncoder)
+    encoder.tokenizer, encoder.session, encoder.pad_id = Tokenizer(), Session(), 0
+    encoder.input_names = {"input_ids", "attention_mask", "token_type_ids"}
+    encoder.normalize = False
+    return encoder
+
+
+def test_batches_by_token_count():
+    model = encoder()
+    sentences = ["a b c d e", "averyveryverylongword", "a b", "a b c d e f g h", "x y z"]
+    embeddings = model.encode(sentences, batch_size=2)
+    # Longest in tokens first, each batch padded only to its own longest sentence
+    assert model.session.shapes == [(2, 8), (2, 3), (1, 1)]
+    np.testing.assert_allclose(embeddings[:, 0], [(len(s.split()) + 1) / 2 for s in sentences])
+
+
+def test_single_sentence_and_empty_input():
+    model = encoder()
+    np.testing.assert_allclose(model.encode("a b c"), [2.0, 2.0])
+    assert model.encode([]).shape == (0, 0)
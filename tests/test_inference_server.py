@@ -0,0 +1,93 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import process_ml
+from inference_server import InferenceClient, InferenceServer
+
+
+@pytest.fixture
+def serve(tmp_path, monkeypatch):
+    # InferenceServer switches process_ml to in-process classification, undo that afterwards
+    monkeypatch.setattr(process_ml, "ML_SERVER_SOCKET", process_ml.ML_SERVER_SOCKET)
+    servers = []
+
+    def start(classify_batch, **kwargs):
+        server = InferenceServer(str(tmp_path / "ml.sock"), classify_batch=classify_batch, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def upper(messages, return_confidence=False):
+    time.sleep(0.01)
+    return [(message.upper(), 0.9) for message in messages]
+
+
+def test_concurrent_requests_share_batches(serve):
+    batches = []
+
+    def classify_batch(messages, return_confidence=False):
+        batches.append(len(messages))
+        return upper(messages)
+
+    server = serve(classify_batch, max_batch=64, max_wait_ms=20)
+    client = InferenceClient(server.server_address, timeout=10)
+
+    def request(i):
+        return client.classify([f"a{i}", f"b{i}"])
+
+    with ThreadPoolExecutor(16) as pool:
+        answers = list(pool.map(request, range(32)))
+    for i, (labels, confidences, model_version, embedding_version) in enumerate(answers):
+        assert labels == [f"A{i}", f"B{i}"] and confidences == [0.9, 0.9]
+        assert embedding_version == process_ml.embedding_version()
+    assert sum(batches) == 64 and len(batches) < 32
+    assert max(batches) <= 64 + 2  # a batch stops growing once it reaches max_batch
+
+
+def test_errors_are_returned_to_the_sender(serve):
+    def failing(messages, return_confidence=False):
+        raise ValueError("model exploded")
+
+    server = serve(failing)
+    with pytest.raises(RuntimeError, match="model exploded"):
+        InferenceClient(server.server_address, timeout=10).classify(["x"])
+
+
+def test_unreachable_and_slow_servers_raise_connection_error(serve, tmp_path):
+    with pytest.raises(ConnectionError):
+        InferenceClient(str(tmp_path / "missing.sock"), timeout=1).classify(["x"])
+
+    def slow(messages, return_confidence=False):
+        time.sleep(1)
+        return upper(messages)
+
+    server = serve(slow)
+    with pytest.raises(ConnectionError, match="did not answer"):
+        InferenceClient(server.server_address, timeout=0.2).classify(["x"])
+
+
+def test_workers_fall_back_and_use_the_servers_versions(serve, tmp_path, monkeypatch):
+    server = serve(upper)
+    monkeypatch.setattr(process_ml, "ML_SERVER_SOCKET", server.server_address)
+    monkeypatch.setattr(process_ml, "_server_client", None)
+    monkeypatch.setattr(process_ml, "_server_versions", None)
+    monkeypatch.setattr(process_ml, "model_version", "daemon-model")
+
+    assert process_ml._classify_on_server(["disk full"]) == (["DISK FULL"], [0.9])
+    assert process_ml.current_model_version() == "daemon-model"
+    assert process_ml.embedding_version() == process_ml._server_versions[1]
+
+    server.shutdown()
+    server.server_close()
+    process_ml._server_client._close()  # as when the daemon's process exits
+    assert process_ml._classify_on_server(["disk full"]) is None  # the caller classifies in process
+    assert process_ml._server_versions is None
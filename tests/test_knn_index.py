@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+
+from knn_index import VectorKNN
+
+
+def embeddings(rng, count, dim=32):
+    vectors = rng.normal(size=(count, dim))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("weights", ["uniform", "distance"])
+def test_matches_sklearn(weights):
+    rng = np.random.default_rng(0)
+    train = embeddings(rng, 500)
+    labels = rng.choice(["Workflow Error", "Deprecation", "Security Alert"], size=len(train))
+    classifier = KNeighborsClassifier(n_neighbors=5, weights=weights).fit(train, labels)
+    index = VectorKNN.from_classifier(classifier)
+
+    queries = embeddings(rng, 200)
+    assert index.predict(queries).tolist() == classifier.predict(queries).tolist()
+    np.testing.assert_allclose(index.predict_proba(queries), classifier.predict_proba(queries), atol=1e-5)
+    _, expected = classifier.kneighbors(queries)
+    _, got = index.kneighbors(queries, batch_size=64)
+    assert (got == expected).all()
+
+
+def test_exact_match_takes_all_weight():
+    rng = np.random.default_rng(1)
+    train = embeddings(rng, 50)
+    labels = np.array(["a", "b"] * 25)
+    classifier = KNeighborsClassifier(n_neighbors=5, weights="distance").fit(train, labels)
+    index = VectorKNN.from_classifier(classifier)
+    assert index.predict(train[:10]).tolist() == labels[:10].tolist()
+    np.testing.assert_allclose(index.predict_proba(train[:10]).max(axis=1), 1.0)
+
+
+def test_save_and_load(tmp_path):
+    rng = np.random.default_rng(2)
+    train = embeddings(rng, 100)
+    classifier = KNeighborsClassifier(n_neighbors=3).fit(train, rng.choice(["x", "y"], size=len(train)))
+    index = VectorKNN.from_classifier(classifier)
+    index.save(str(tmp_path))
+    loaded = VectorKNN.load(str(tmp_path))
+    queries = embeddings(rng, 20)
+    assert loaded.predict(queries).tolist() == index.predict(queries).tolist()
+
+
+def test_rejects_other_metrics():
+    rng = np.random.default_rng(3)
+    classifier = KNeighborsClassifier(metric="cosine", algorithm="brute").fit(embeddings(rng, 10), ["a"] * 10)
+    with pytest.raises(ValueError):
+        VectorKNN.from_classifier(classifier)
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+
+import metrics
+import process_LLM
+from embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    # A fresh cache, no rate limit and no backoff sleeps
+    monkeypatch.setattr(process_LLM, "llm_cache", EmbeddingCache(maxsize=1000, table="llm_cache"))
+    monkeypatch.setattr(process_LLM, "rate_limiter", process_LLM.TokenBucket(0, 1))
+    monkeypatch.setattr(process_LLM, "LLM_BACKOFF_SECONDS", 0)
+    monkeypatch.setattr(process_LLM, "LLM_MAX_RETRIES", 2)
+    return process_LLM
+
+
+class FlakyClient(process_LLM.FakeClient):
+    """Fails the first `failures` requests, then answers like FakeClient."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+
+    def generate_content(self, model, contents, config=None):
+        with self._lock:
+            self.attempts += 1
+            failing = self.attempts <= self.failures
+        if failing:
+            raise ConnectionError("transient")
+        return super().generate_content(model, contents, config)
+
+
+def test_token_bucket_waits_for_tokens():
+    bucket = process_LLM.TokenBucket(rate=20, capacity=2)
+    started = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # Two from the burst, then one every 1/20 s
+    assert 0.08 <= time.monotonic() - started < 1
+
+
+def test_token_bucket_without_rate_never_waits():
+    bucket = process_LLM.TokenBucket(rate=0, capacity=1)
+    started = time.monotonic()
+    for _ in range(100):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.05
+
+
+def test_transient_errors_are_retried(llm):
+    client = FlakyClient(failures=2)
+    assert llm.classify_with_llm_batch(["Workflow step failed"], client) == ["Workflow Error"]
+    assert client.attempts == 3
+
+
+def test_exhausted_retries_give_unknown_and_are_counted(llm):
+    client = FlakyClient(failures=100)
+    failures = metrics.LLM_REQUEST_FAILURES.value()
+    stats = llm.llm_stats()
+    assert llm.classify_with_llm_batch(["Workflow step failed", "API retired"], client, prompt_batch_size=1) == \
+        ["Unknown", "Unknown"]
+    assert client.attempts == 2 * (llm.LLM_MAX_RETRIES + 1)
+    assert metrics.LLM_REQUEST_FAILURES.value() == failures + 2
+    after = llm.llm_stats()
+    assert after['failed_requests'] - stats['failed_requests'] == 2
+    assert after['failed_messages'] - stats['failed_messages'] == 2
+
+
+def test_failed_answers_are_not_cached(llm):
+    client = FlakyClient(failures=llm.LLM_MAX_RETRIES + 1)
+    assert llm.classify_with_llm_batch(["Workflow step failed"], client) == ["Unknown"]
+    # The API is back: the message is asked again, then answered from the cache
+    assert llm.classify_with_llm_batch(["Workflow step failed"], client) == ["Workflow Error"]
+    calls = client.attempts
+    assert llm.classify_with_llm_batch(["Workflow step failed"], client) == ["Workflow Error"]
+    assert client.attempts == calls
+
+
+def test_requests_carry_the_timeout(llm):
+    seen = []
+
+    class Client(process_LLM.FakeClient):
+        def generate_content(self, model, contents, config=None):
+            seen.append(config)
+            return super().generate_content(model, contents, config)
+
+    llm.classify_with_llm_batch(["API retired"], Client())
+    assert seen == [{"http_options": {"timeout": int(llm.LLM_TIMEOUT_SECONDS * 1000)}}]
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ('["Workflow Error", "Deprecation", "Unknown"]', ["Workflow Error", "Deprecation", "Unknown"]),
+    ('```json\n["deprecation", "workflow error."]\n```', ["Deprecation", "Workflow Error"]),
+    ('Sure! Here you go: ["Deprecation", "Banana", 3]', ["Deprecation", None, None]),
+    ('["Deprecation"]', ["Deprecation", None, None]),  # short
+    ('["Deprecation", "Unknown", "Unknown", "Deprecation"]', ["Deprecation", "Unknown", "Unknown"]),  # long
+    ('Deprecation', [None, None, None]),  # not a list
+    ('[not json', [None, None, None]),
+])
+def test_parse_batch_reply(reply, expected):
+    assert process_LLM._parse_batch_reply(reply, len(expected)) == expected
+
+
+def test_bad_items_are_asked_again_one_by_one(llm):
+    class Client(process_LLM.FakeClient):
+        # The batched reply loses its second answer
+        def generate_content(self, model, contents, config=None):
+            response = super().generate_content(model, contents, config)
+            if "Log messages:" in contents:
+                response.text = response.text.replace('"Deprecation"', '"???"')
+            return response
+
+    client = Client()
+    stats = llm.llm_stats()
+    messages = ["Workflow step failed", "API retired", "Hello world"]
+    assert llm.classify_with_llm_batch(messages, client, prompt_batch_size=3) == \
+        ["Workflow Error", "Deprecation", "Unknown"]
+    after = llm.llm_stats()
+    assert client.calls == 2
+    assert after['batched_requests'] - stats['batched_requests'] == 1
+    assert after['individual_retries'] - stats['individual_retries'] == 1
+
+
+def test_messages_are_grouped_by_prompt_batch_size(llm):
+    client = process_LLM.FakeClient()
+    messages = [f"Workflow step {name} failed" for name in "abcdefg"]  # distinct templates
+    assert llm.classify_with_llm_batch(messages, client, prompt_batch_size=3) == ["Workflow Error"] * 7
+    assert client.calls == 3
+
+
+def test_prompt_batch_size_is_exported(llm):
+    llm.classify_with_llm_batch(["Workflow step x failed", "API y retired"], llm.FakeClient(), prompt_batch_size=5)
+    text = metrics.render()
+    assert "log_classifier_llm_prompt_batch_size 5" in text
+    assert 'log_classifier_llm_messages_per_request_bucket{le="2"}' in text
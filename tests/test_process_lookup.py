@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+import pytest
+
+import classify
+import process_lookup
+
+
+@pytest.fixture
+def lookup(tmp_path, monkeypatch):
+    seed = tmp_path / "seed.csv"
+    seed.write_text(
+        "source,log_message,target_label\n"
+        "ModernHR,Disk cleanup completed,System Notification\n"
+        "ModernHR,Request 17 timed out after 30s,Error\n"
+        "ModernHR,Request 99 timed out after 30s,Error\n"
+        "ModernHR,Queue 1 stalled,Error\n"
+        "ModernHR,Queue 2 stalled,Warning\n"
+        "LegacyCRM,Invoice 5 rejected,Workflow Error\n"
+    )
+    monkeypatch.setattr(process_lookup, "LOOKUP_SEED_PATH", str(seed))
+    monkeypatch.setattr(process_lookup, "LOOKUP_MAX_SIZE", 3)
+    for name, value in (("_exact", {}), ("_templates", {}), ("_learned", OrderedDict()), ("_learned_version", None),
+                        ("_seed_mtime", None), ("_seed_version", None), ("_last_refresh", 0.0)):
+        monkeypatch.setattr(process_lookup, name, value)
+    return process_lookup
+
+
+def test_seed_exact_and_template_hits(lookup):
+    assert lookup.classify_with_lookup("Disk cleanup completed", with_origin=True) == ("System Notification", "seed")
+    # Same template as two seed rows that agree
+    assert lookup.classify_with_lookup("Request 5 timed out after 2s") == "Error"
+    # The queue template is ambiguous in the seed, and LegacyCRM rows are not used
+    assert lookup.classify_with_lookup("Queue 3 stalled") is None
+    assert lookup.classify_with_lookup("Invoice 5 rejected") is None
+    assert lookup.seed_version() not in (None, "off")
+
+
+def test_learned_hits_need_the_same_version(lookup):
+    lookup.remember(["Cache 1 warmed in 3ms", "Job 7 vanished"], ["Info", "Unknown"], version="v1")
+    assert lookup.classify_with_lookup("Cache 2 warmed in 9ms", True, "v1") == ("Info", "learned")
+    assert lookup.classify_with_lookup("Job 8 vanished", True, "v1") == (None, None)  # Unknown is not remembered
+    # Answers from an older model or rule set are not served
+    assert lookup.classify_with_lookup("Cache 2 warmed in 9ms", True, "v2") == (None, None)
+    assert lookup.classify_with_lookup("Cache 2 warmed in 9ms") is None
+
+    lookup.remember(["Backup 3 verified"], ["Info"], version="v2")
+    assert lookup.classify_with_lookup("Cache 2 warmed in 9ms", learned_version="v2") is None
+    assert lookup.classify_with_lookup("Backup 4 verified", learned_version="v2") == "Info"
+
+
+def test_seed_templates_are_not_learned(lookup):
+    lookup.refresh()
+    lookup.remember(["Request 1 timed out after 1s"], ["Warning"], version="v1")
+    assert lookup.lookup_stats()['learned_entries'] == 0
+    assert lookup.classify_with_lookup("Request 1 timed out after 1s", learned_version="v1") == "Error"
+
+
+def test_learned_answers_are_evicted_oldest_first(lookup):
+    lookup.remember([f"Worker {name} 1 restarted" for name in "abcd"], ["Info"] * 4, version="v1")
+    lookup.remember(["Worker b 2 restarted"], ["Info"], version="v1")  # used again, so kept
+    lookup.remember(["Worker e 1 restarted"], ["Info"], version="v1")
+    assert lookup.lookup_stats()['learned_entries'] == 3
+    hits = {name for name in "abcde" if lookup.classify_with_lookup(f"Worker {name} 9 restarted", learned_version="v1")}
+    assert hits == {"b", "d", "e"}
+
+
+def test_classify_asks_the_model_again_after_a_new_version(lookup, monkeypatch):
+    calls = []
+
+    def ml(messages, return_confidence=False):
+        calls.append(list(messages))
+        return [(f"label from {version[0]}", 0.99) for _ in messages]
+
+    version = ["v1"]
+    monkeypatch.setattr(classify, "classify_with_ml_batch", ml)
+    monkeypatch.setattr(classify, "learned_version", lambda: version[0])
+    monkeypatch.setattr(classify, "ENABLED_TIERS", frozenset({"lookup", "regex", "ml"}))
+
+    assert classify._classify([("ModernHR", "Cache 1 warmed in 3ms")])[0] == ["label from v1"]
+    labels, report = classify._classify([("ModernHR", "Cache 2 warmed in 5ms")])
+    assert labels == ["label from v1"] and report['counts']['lookup'] == 1 and len(calls) == 1
+
+    version[0] = "v2"  # retrained model or new rules
+    labels, report = classify._classify([("ModernHR", "Cache 3 warmed in 7ms")])
+    assert labels == ["label from v2"] and report['tiers'] == ["ml"] and len(calls) == 2
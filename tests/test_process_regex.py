@@ -0,0 +1,63 @@
+import os
+import re
+
+import pandas as pd
+import pytest
+
+import process_regex
+from conftest import ROOT
+
+
+def reference(patterns, log_message):
+    # The original engine: every rule in order, compiled on each call
+    for pattern, label in patterns.items():
+        if re.search(pattern, log_message, re.IGNORECASE):
+            return label
+    return None
+
+
+@pytest.fixture
+def restore_patterns():
+    patterns = dict(process_regex.REGEX_PATTERNS)
+    yield
+    process_regex.load_patterns(patterns)
+
+
+def test_matches_reference_on_dataset():
+    messages = pd.read_csv(os.path.join(ROOT, "dataset/synthetic_logs.csv"))["log_message"]
+    expected = [reference(process_regex.REGEX_PATTERNS, message) for message in messages]
+    assert [process_regex.classify_with_regex(message) for message in messages] == expected
+    assert process_regex.classify_each_with_regex(messages).tolist() == expected
+
+
+@pytest.mark.parametrize("message", [
+    "user User123 logged in.",
+    "BACKUP ENDED AT 10:00",
+    "Backup completed successfully!",
+    "prefix: System updated to version 2.1",
+    "Account with ID 7 created by admin",
+    "Disk cleanup failed",
+    "",
+    "Fİle x uploaded successfully by user y",  # non-ASCII skips the prefilter
+])
+def test_matches_reference_on_edge_cases(message):
+    assert process_regex.classify_with_regex(message) == reference(process_regex.REGEX_PATTERNS, message)
+
+
+def test_prefilter_keeps_alternation_and_optional_prefixes(restore_patterns):
+    patterns = {
+        r"error|fatal": "Alert",
+        r"Retrys? exhausted": "Retry",
+        r"a{0}Leading quantifier": "Odd",
+        r"Backup (started|ended)": "System Notification",
+    }
+    process_regex.load_patterns(patterns)
+    for message in ["FATAL crash", "Retry exhausted", "Retrys exhausted", "Leading quantifier",
+                    "backup started", "nothing here"]:
+        assert process_regex.classify_with_regex(message) == reference(patterns, message)
+
+
+def test_rules_version_follows_rule_order(restore_patterns):
+    version = process_regex.RULES_VERSION
+    process_regex.load_patterns(dict(reversed(list(process_regex.REGEX_PATTERNS.items()))))
+    assert process_regex.RULES_VERSION != version
@@ -0,0 +1,42 @@
+import pytest
+
+import columnar
+import db
+import reclassify
+
+VERSIONS = {'lookup': 'l1', 'regex': 'r1', 'ml': 'm1', 'llm': 'p1'}
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(columnar, "RESULTS_DIR", str(tmp_path / "results"))
+    return db.connect(str(tmp_path / "users.db"))
+
+
+def columns(conn, table_name):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')]
+
+
+def test_stale_rows_does_not_migrate_old_tables(conn):
+    with conn:
+        conn.execute('CREATE TABLE old_upload (id INTEGER PRIMARY KEY, source TEXT, log_message TEXT, target_label TEXT)')
+        conn.executemany('INSERT INTO old_upload (source, log_message, target_label) VALUES (?, ?, ?)',
+                         [('ModernHR', 'a', 'Error'), ('LegacyCRM', 'b', 'Deprecation'), (None, 'c', 'Error')])
+    before = columns(conn, 'old_upload')
+    # Rows of unknown provenance are re-run, except LegacyCRM ones
+    assert reclassify.stale_rows(conn, 'old_upload', VERSIONS) == 2
+    assert columns(conn, 'old_upload') == before
+
+
+def test_stale_rows_compares_stamps(conn):
+    with conn:
+        conn.execute('CREATE TABLE upload (id INTEGER PRIMARY KEY, source TEXT, log_message TEXT, target_label TEXT, '
+                     'tier TEXT, label_version TEXT)')
+        conn.executemany('INSERT INTO upload (source, log_message, target_label, tier, label_version) VALUES (?, ?, ?, ?, ?)',
+                         [('ModernHR', 'a', 'Error', 'ml', 'm1'), ('ModernHR', 'b', 'Error', 'ml', 'm0'),
+                          ('ModernHR', 'c', 'Error', 'regex', 'r0'), ('LegacyCRM', 'd', 'Error', 'llm', 'p0')])
+    assert reclassify.stale_rows(conn, 'upload', VERSIONS) == 2
+
+
+def test_stale_rows_of_a_missing_table(conn):
+    assert reclassify.stale_rows(conn, 'dropped_upload', VERSIONS) is None
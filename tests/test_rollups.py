@@ -0,0 +1,106 @@
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+import columnar
+import db
+import jobs
+import reclassify
+import rollups
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(columnar, "RESULTS_DIR", str(tmp_path / "results"))
+    db_path = str(tmp_path / "users.db")
+    conn = db.connect(db_path)
+    with conn:
+        # The uploads and label summary tables as app.init_db creates them
+        conn.execute('''
+            CREATE TABLE uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                upload_date TEXT NOT NULL,
+                table_name TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE upload_label_counts (
+                table_name TEXT NOT NULL,
+                target_label TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                first_id INTEGER NOT NULL,
+                PRIMARY KEY (table_name, target_label)
+            )
+        ''')
+    jobs.init_jobs_table(db_path)
+    rollups.init_rollup_table(db_path)
+    reclassify.init_reclassify_table(db_path)
+    return conn
+
+
+def counts_of(conn, table_name):
+    return {(source, label): count for source, label, count in conn.execute(
+        'SELECT source, target_label, count FROM user_label_rollups WHERE table_name = ?', (table_name,))}
+
+
+def upload(conn, username, table_name, rows):
+    counts = Counter()
+    rollups.count_chunk(counts, pd.DataFrame(rows, columns=['source', 'target_label']))
+    jobs.register_upload(conn, username, f"{table_name}.csv", table_name, counts)
+
+
+def test_add_upload_counts_rows(conn):
+    upload(conn, 'alice', 'logs_a', [('HR', 'Error'), ('HR', 'Error'), (None, 'Deprecation'), ('CRM', None)])
+    upload(conn, 'alice', 'logs_b', [('HR', 'Error')])
+    upload(conn, 'bob', 'logs_c', [('HR', 'Deprecation')])
+
+    assert counts_of(conn, 'logs_a') == {('HR', 'Error'): 2, ('', 'Deprecation'): 1}
+    dashboard = rollups.dashboard(conn, 'alice')
+    assert dashboard['total_logs'] == 4
+    assert dashboard['label_counts'] == {'Error': 3, 'Deprecation': 1}
+    assert dashboard['by_source'] == {'': {'Deprecation': 1}, 'HR': {'Error': 3}}
+    assert set(dashboard['by_upload']) == {'logs_a', 'logs_b'}
+
+
+def test_apply_changes_moves_rows_between_labels(conn):
+    upload(conn, 'alice', 'logs_a', [('HR', 'Error'), ('HR', 'Error'), ('CRM', 'Deprecation')])
+    with conn:
+        rollups.apply_changes(conn, 'logs_a', ['HR', 'HR', 'CRM'], ['Error', 'Error', 'Deprecation'],
+                              ['Error', 'Unknown', 'Unknown'])
+    assert counts_of(conn, 'logs_a') == {('HR', 'Error'): 1, ('HR', 'Unknown'): 1, ('CRM', 'Unknown'): 1}
+
+
+def test_apply_changes_leaves_uploads_without_rollups_to_backfill(conn):
+    jobs.register_upload(conn, 'alice', 'old.csv', 'logs_old')  # stored before rollups existed
+    with conn:
+        conn.execute('CREATE TABLE logs_old (id INTEGER PRIMARY KEY, source TEXT, target_label TEXT)')
+        conn.executemany('INSERT INTO logs_old (source, target_label) VALUES (?, ?)',
+                         [('HR', 'Error'), ('HR', 'Unknown'), (None, 'Error')])
+        rollups.apply_changes(conn, 'logs_old', ['HR'], ['Error'], ['Unknown'])
+    assert counts_of(conn, 'logs_old') == {}
+
+    rollups.backfill(conn, 'alice')
+    assert counts_of(conn, 'logs_old') == {('HR', 'Error'): 1, ('HR', 'Unknown'): 1, ('', 'Error'): 1}
+    assert conn.execute("SELECT rollups_at FROM uploads WHERE table_name = 'logs_old'").fetchone()[0]
+
+
+def test_empty_upload_is_backfilled_once(conn, monkeypatch):
+    jobs.register_upload(conn, 'alice', 'empty.csv', 'logs_empty')
+    rebuilt = []
+    rebuild = rollups.rebuild
+    monkeypatch.setattr(rollups, "rebuild", lambda conn, table_name: rebuilt.append(table_name) or rebuild(conn, table_name))
+    rollups.backfill(conn, 'alice')
+    rollups.backfill(conn, 'alice')
+    assert rebuilt == ['logs_empty']
+
+
+def test_delete_upload_removes_rollups(conn):
+    upload(conn, 'alice', 'logs_a', [('HR', 'Error')])
+    upload(conn, 'alice', 'logs_b', [('HR', 'Deprecation')])
+    assert not jobs.delete_upload(conn, 'bob', 'logs_a')  # not bob's
+    assert jobs.delete_upload(conn, 'alice', 'logs_a')
+    assert counts_of(conn, 'logs_a') == {}
+    assert rollups.dashboard(conn, 'alice')['label_counts'] == {'Deprecation': 1}